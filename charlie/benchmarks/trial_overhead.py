@@ -0,0 +1,324 @@
+"""
+Benchmarks of the overhead batch.Test adds between the trials of each test.
+For example,
+
+    python -m charlie.benchmarks.trial_overhead -b olin -p BENCH
+
+runs every pygame test in the olin batch headlessly (see
+charlie.tools.headless). Time is virtual there, so stimulus durations, ITIs
+and waits for responses take no real time. Whatever real time is left
+between one trial ending and the next one starting is overhead: saving the
+data, exporting csv, the stopping rule, printing, and so on. Images loaded
+on the main thread during a trial also count towards the overhead. Results
+are in ms per trial for each test, broken down by stage.
+
+The results are compared with the JSON baseline in BASELINE_PATH named by
+--baseline. A test has regressed if one of its metrics exceeds the baseline
+by more than THRESHOLD and by at least NOISE_MS. With --update_baseline, the
+results are saved as the new baseline instead. Baselines are only comparable
+on the machine they were recorded on. The exit status is 1 if anything
+regressed.
+
+Each test is run REPEATS times and the median of each metric is reported.
+TEST data are never saved, so a different proband ID is needed. Data are
+written to temporary directories rather than the package's data, which are
+deleted after each repeat unless --keep is given.
+"""
+
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import charlie.tools.arguments as arguments
+import charlie.tools.batch as batch
+import charlie.tools.data as data
+import charlie.tools.events as events
+import charlie.tools.headless as headless
+import charlie.tools.visual as visual
+
+
+BASELINE_PATH = data.pj(os.path.dirname(os.path.abspath(__file__)),
+                        'baselines')
+THRESHOLD = 0.25
+NOISE_MS = 2.
+SEED = 0
+REPEATS = 3
+STAGES = ['save', 'csv', 'stopping_rule', 'print', 'images']
+METRICS = ['total', 'total_p95', 'between'] + STAGES
+
+
+class Profiler:
+
+    """
+    Adds up the time spent in wrapped functions, by stage. Only exclusive
+    time is counted: time spent in a wrapped function called from another
+    only counts against the inner one. Calls from threads other than the
+    main one (e.g., the preloader) do not hold up the test and are ignored.
+    """
+
+    def __init__(self):
+        self.totals = dict((stage, 0.) for stage in STAGES)
+        self.stack = []
+
+    def wrap(self, stage, f):
+        """
+        Returns a function that calls f and adds its time to the stage.
+        """
+        def wrapper(*args, **kwargs):
+            if threading.current_thread().name != 'MainThread':
+                return f(*args, **kwargs)
+            self.stack.append(0.)
+            t0 = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                t = time.time() - t0
+                self.totals[stage] += t - self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += t
+        return wrapper
+
+    def reset(self):
+        """
+        Returns the totals so far and sets them to zero.
+        """
+        totals = self.totals
+        self.totals = dict((stage, 0.) for stage in STAGES)
+        return totals
+
+
+class TimedStream:
+
+    """
+    Wraps sys.stdout so that the time spent printing can be profiled.
+    """
+
+    def __init__(self, stream, profiler):
+        self.stream = stream
+        self.write = profiler.wrap('print', stream.write)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def install(profiler, mod):
+    """
+    Wraps the functions behind each stage, including the test module's
+    stopping rule if it has one. Returns a list of (owner, name, original)
+    tuples for uninstall.
+    """
+    targets = [
+        (data, 'save_data', 'save'),
+        (data, 'append_journal', 'save'),
+        (data.Data, 'to_csv', 'csv'),
+        (visual.SurfaceCache, 'get', 'images'),
+    ]
+    if hasattr(mod, 'stopping_rule'):
+        targets.append((mod, 'stopping_rule', 'stopping_rule'))
+    patches = []
+    for owner, name, stage in targets:
+        original = owner.__dict__[name]
+        patches.append((owner, name, original))
+        setattr(owner, name, profiler.wrap(stage, original))
+    patches.append((sys, 'stdout', sys.stdout))
+    sys.stdout = TimedStream(sys.stdout, profiler)
+    return patches
+
+
+def uninstall(patches):
+    """
+    Puts back the originals replaced by install.
+    """
+    for owner, name, original in reversed(patches):
+        setattr(owner, name, original)
+
+
+def benchmark_test(test_name):
+    """
+    Runs one test headlessly and measures the overhead of every trial but the
+    last. Returns a list of dicts of seconds, one per trial, or None if the
+    test is not a pygame test.
+    """
+    if not batch.is_pygame_test(test_name):
+        print '---Skipping %s: it is not a pygame test.' % test_name
+        return None
+    test = batch.Test(test_name, True)
+    profiler = Profiler()
+    trials = []
+    ended = []
+    trial_method = getattr(test.mod, 'trial_method')
+
+    def timed_trial_method(*args):
+        totals = profiler.reset()
+        if ended:
+            totals['between'] = time.time() - ended[0]
+            trials.append(totals)
+        try:
+            return trial_method(*args)
+        finally:
+            ended[:] = [time.time()]
+
+    patches = install(profiler, test.mod)
+    patches.append((test.mod, 'trial_method', trial_method))
+    test.mod.trial_method = timed_trial_method
+    try:
+        test.run_pygame()
+    finally:
+        uninstall(patches)
+    return trials
+
+
+def summarise(trials):
+    """
+    Returns a dict of metrics, in ms per trial, from the output of
+    benchmark_test. The total is the gap between trials plus the images
+    loaded during the trial before it.
+    """
+    t = dict((k, np.array([trial[k] for trial in trials]) * 1000) for k in
+             ['between'] + STAGES)
+    total = t['between'] + t['images']
+    results = {'trials': len(trials), 'total': total.mean(),
+               'total_p95': np.percentile(total, 95)}
+    for k in ['between'] + STAGES:
+        results[k] = t[k].mean()
+    return results
+
+
+def run(test_names, seed=SEED, repeats=REPEATS, keep=False):
+    """
+    Benchmarks each test the given number of times, each time with the same
+    responses, an empty data directory and empty image caches. Returns a dict
+    of metrics keyed by test name, each the median across repeats. The data
+    directories are deleted afterwards unless keep is True.
+    """
+    runs = {}
+    for i in range(repeats):
+        path = tempfile.mkdtemp(prefix='charlie_benchmark_')
+        data.set_data_path(path)
+        try:
+            events.set_script(headless.ResponseScript(seed=seed))
+            visual.surface_cache.clear()
+            visual.text_cache.clear()
+            for test_name in test_names:
+                trials = benchmark_test(test_name)
+                if trials:
+                    runs.setdefault(test_name, []).append(summarise(trials))
+        finally:
+            data.flush()
+            if keep:
+                print '---Kept the data from repeat %i in %s.' % (i, path)
+            else:
+                shutil.rmtree(path, True)
+    results = {}
+    for test_name, summaries in runs.iteritems():
+        results[test_name] = dict((k, np.median([m[k] for m in summaries]))
+                                  for k in summaries[0])
+    return results
+
+
+def baseline_filename(name):
+    """
+    Returns the path of the named baseline.
+    """
+    return data.pj(BASELINE_PATH, name + '.json')
+
+
+def save_baseline(results, name):
+    """
+    Saves the results as the named baseline.
+    """
+    if not os.path.exists(BASELINE_PATH):
+        os.makedirs(BASELINE_PATH)
+    baseline = {
+        'recorded': str(datetime.now()),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'tests': results
+    }
+    with open(baseline_filename(name), 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def load_baseline(name):
+    """
+    Returns the named baseline, or None if it does not exist.
+    """
+    f = baseline_filename(name)
+    if os.path.exists(f):
+        return json.load(open(f))
+
+
+def compare(results, baseline):
+    """
+    Returns a dict of lists of (metric, baseline value, new value) tuples for
+    the metrics that regressed, keyed by test name.
+    """
+    regressions = {}
+    for test_name, metrics in results.iteritems():
+        old = baseline['tests'].get(test_name)
+        if old is None:
+            continue
+        for k in METRICS:
+            if k in old and metrics[k] > old[k] * (1 + THRESHOLD) and \
+                    metrics[k] - old[k] >= NOISE_MS:
+                regressions.setdefault(test_name, []).append(
+                    (k, old[k], metrics[k]))
+    return regressions
+
+
+def print_report(results, baseline=None, regressions=None):
+    """
+    Prints the results as a table, along with how they compare with the
+    baseline.
+    """
+    print '%-22s %6s %s  %s' % ('test', 'trials', ' '.join(
+        '%9s' % k[:9] for k in METRICS), 'baseline')
+    for test_name in sorted(results):
+        metrics = results[test_name]
+        if baseline is None or test_name not in baseline['tests']:
+            status = 'none'
+        elif test_name in (regressions or {}):
+            status = 'REGRESSED'
+        else:
+            status = 'ok'
+        print '%-22s %6i %s  %s' % (test_name, metrics['trials'], ' '.join(
+            '%9.2f' % metrics[k] for k in METRICS), status)
+    print 'Times in ms per trial.'
+    for test_name, rows in sorted((regressions or {}).iteritems()):
+        for k, old, new in rows:
+            print '%s: %s went from %.2f to %.2f ms (%+.0f%%).' % (
+                test_name, k, old, new, (new / old - 1) * 100 if old else 0)
+
+
+def main():
+    args = arguments.get_args()
+    if args.proband_id == 'TEST':
+        sys.exit('Benchmarks need a proband ID other than TEST (e.g., '
+                 '-p BENCH).')
+    headless.enable()
+    if args.batch_file:
+        test_names = batch.tests_in_batch(args.batch_file)
+    else:
+        test_names = [args.test_name]
+    results = run(test_names, SEED if args.seed is None else args.seed,
+                  keep=args.keep)
+    if args.update_baseline:
+        save_baseline(results, args.baseline)
+        print_report(results)
+        print '---Saved as baseline %s.' % args.baseline
+        return
+    baseline = load_baseline(args.baseline)
+    regressions = compare(results, baseline) if baseline else {}
+    print_report(results, baseline, regressions)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -92,6 +92,9 @@ class SetupTab(QtGui.QWidget):
         self.probands_list = self.df.proband_id.unique().tolist()
         self.db = QtSql.QSqlDatabase.addDatabase("QSQLITE")
         self.db.setDatabaseName(data.LOCAL_DB_F)
+        self.db.setConnectOptions(
+            'QSQLITE_BUSY_TIMEOUT=%i' % (data.DB_TIMEOUT * 1000)
+        )
         self.db.open()
         self.model = QtSql.QSqlTableModel()
         self.model.setTable('probands')
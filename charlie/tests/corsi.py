@@ -91,8 +91,8 @@ test_name = 'corsi'
 output_format = [
     ('proband_id', str), ('test_name', str), ('condition', str),
     ('phase', str), ('trialn', str), ('n', int), ('positions', str),
-    ('symbols', str), ('correct', int), ('rt', int), ('responses', str),
-    ('rt_first', int)
+    ('symbols', str), ('correct', int), ('rt', float), ('responses', str),
+    ('rt_first', float), ('onset_time', float), ('rsp_time', float)
 ]
 conditions = ['simultaneous', 'forward', 'sequence']
 ns = [n for n in xrange(2, 15) for i in xrange(3)]
@@ -750,8 +750,7 @@ def trial_method(screen, instructions, trial_info):
 
     # blit and pause
     [screen.blit_rectangle(rect) for rect in squares]
-    screen.update()
-    events.wait(pre_trial_dur)
+    screen.present(pre_trial_dur, 'squares')
 
     # play study sequence
     fdic = {
@@ -768,24 +767,18 @@ def trial_method(screen, instructions, trial_info):
             markers.append(r)
 
             if 'simultaneous' not in condition:
-                screen.update()
-                events.wait(study_dur)
+                screen.present(study_dur, 'study %i' % i)
                 screen.wipe(r, force_hide_mouse=True, update=False, prc=False)
-                screen.update()
-                events.wait(wipe_dur)
-    screen.update()
-    events.wait(pre_trial_dur / 2.)
-    screen.wipe()
-    screen.update()
-    events.wait(pre_trial_dur / 2.)
-    screen.wipe()
+                screen.present(wipe_dur, 'wipe %i' % i)
+    screen.present(pre_trial_dur / 2., 'markers')
+    screen.wipe(update=False)
+    screen.present(pre_trial_dur / 2., 'blank')
+    screen.wipe(update=False)
     [screen.blit_rectangle(rect) for rect in squares]
-    screen.update()
+    onset = screen.present(label='response')
     screen.reset_zones()
     screen.create_rect_zones(squares)
     screen.reset_mouse_pos()
-    trial_clock = events.Clock()
-    trial_clock.tick_busy_loop()
     responses = []
     corcount = 0
 
@@ -836,10 +829,11 @@ def trial_method(screen, instructions, trial_info):
             break
 
     # end of trial
+    _, last = events.response_times()
     trial_info = tuple(
         list(trial_info) + [
-            corr, trial_clock.tick_busy_loop(),
-            repr(responses), responses[0][1]
+            corr, (events.now() - onset) * 1000.,
+            repr(responses), responses[0][1], onset, last
         ]
     )
     return trial_info
@@ -55,12 +55,13 @@ __version__ = 1.1
 __author__ = 'Sam Mathias'
 
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
 import charlie.tools.audio as audio
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'ctrails'
@@ -72,8 +73,10 @@ output_format = [('proband_id', str),
                  ('n', int),
                  ('rsp', str),
                  ('corr', str),
-                 ('rt', int),
-                 ('total_time', int)]
+                 ('rt', float),
+                 ('total_time', float),
+                 ('onset_time', float),
+                 ('rsp_time', float)]
 
 phases = ('number', 'letter', 'number-letter')
 trial_types = ('practice', 'test')
@@ -156,8 +159,6 @@ def trial_method(screen, instructions, trial_info):
         screen.countdown_splash(5, instructions.pop(0))
 
     # set up trial
-    trial_clock = events.Clock()
-    trial_clock.tick_busy_loop()
     path = data.pj(data.VISUAL_PATH, test_name)
     filename = lambda x: data.pj(path, 'a_%s.png' % str(x))
     pos = positions[phase][trial_type]
@@ -169,9 +170,10 @@ def trial_method(screen, instructions, trial_info):
         image, r = screen.blit_image(filename(item), position, update=False)
         zones.append(r)
     screen.create_rect_zones(zones)
-    screen.flip()
+    onset = screen.flip()
     all_responses = []
     all_rts = []
+    all_times = []
     remaining_responses = list(sequence)
     clicked_zones = []
     
@@ -213,14 +215,16 @@ def trial_method(screen, instructions, trial_info):
         # record response
         response = sequence[r]
         all_responses.append(response)
-        all_rts.append(rt)       
+        all_rts.append(rt)
+        all_times.append(events.response_times())
         
     # trial over; consolidate data
-    total_time = trial_clock.tick_busy_loop()
+    total_time = (events.now() - onset) * 1000.
     data_from_this_trial = []
     remaining_responses = list(sequence)
     
-    for i, response, rt in zip(xrange(len(all_rts)), all_responses, all_rts):
+    for i, response, rt, times in zip(xrange(len(all_rts)), all_responses,
+                                      all_rts, all_times):
         
         t = list(trial_info) + [i, response]
         if response is remaining_responses[0]:
@@ -228,7 +232,7 @@ def trial_method(screen, instructions, trial_info):
             remaining_responses.pop(0)
         else:
             t.append('Incorrect')
-        t += [rt, total_time]
+        t += [rt, total_time] + times
         t = tuple(t)
         
         data_from_this_trial.append(t)
@@ -59,6 +59,7 @@ try:
     from PySide import QtGui, QtCore
 except ImportError:
     from PyQt4 import QtGui, QtCore
+import charlie.tools.audio as audio
 import charlie.tools.data as data
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
@@ -94,6 +95,11 @@ class MainWindow(QtGui.QMainWindow):
         self.instr = instructions
         self.words = self.instr[-1].split('\n')
         self.stimuli = [data.pj(path, w + '.wav') for w in self.words]
+        try:
+            self.timeline = audio.Timeline(self.stimuli, isi / 1000.)
+        except RuntimeError, e:
+            print '---%s; playing each word with QSound instead.' % e
+            self.timeline = None
 
         # load central widget
         self.resize(800, 400)
@@ -151,6 +157,7 @@ class ListenWidget(QtGui.QWidget):
         # import variables from parent
         self.words = self.parent().words
         self.stimuli = self.parent().stimuli
+        self.timeline = self.parent().timeline
         _, _, self.trialn = self.parent().current_trial
         self.instr = self.parent().instr
 
@@ -181,22 +188,30 @@ class ListenWidget(QtGui.QWidget):
 
     def start_events(self):
         """
-        Starts playing the auditory stimuli.
+        Starts playing the auditory stimuli. The whole list plays as one sound
+        in which the words are isi ms apart (see audio.Timeline), so the timer
+        only keeps the display in step with it. If the mixer could not be
+        opened, each word is played with QSound when the timer fires instead.
         """
         self.button.setText(self.instr[10])
         self.button.clicked.disconnect()
         self.timer = QtCore.QBasicTimer()
         self.num_played = 0
+        if self.timeline is not None:
+            self.timeline.play()
+        self.timerEvent(None)
         self.timer.start(isi, self)
 
     def timerEvent(self, e):
         """
-        Reimplemented event handler that plays stimuli and updates the
-        progress bar. Allows experimenter to proceed once done.
+        Reimplemented event handler that shows the word being played and
+        updates the progress bar. Logs the onset of each word and allows
+        the experimenter to proceed once done.
         """
         nstim = len(self.stimuli)
         if self.num_played < nstim:
-            QtGui.QSound.play(self.stimuli[self.num_played])
+            if self.timeline is None:
+                QtGui.QSound.play(self.stimuli[self.num_played])
             msg = self.instr[11] + '\n%s' % self.words[self.num_played]
             self.label.setText(msg)
             self.num_played += 1
@@ -204,6 +219,14 @@ class ListenWidget(QtGui.QWidget):
 
         else:
             self.timer.stop()
+            onsets = None if self.timeline is None else self.timeline.onsets()
+            if onsets is None:
+                msg = 'trial %i word onsets: not measured (no mixer)' % (
+                    self.trialn)
+            else:
+                msg = 'trial %i word onsets: %s' % (self.trialn, ', '.join(
+                    '%s %.4f' % (w, t) for w, t in zip(self.words, onsets)))
+            self.parent().data_obj.to_log(msg)
             self.label.setText(self.instr[12])
             self.button.setText(self.instr[13])
             self.button.clicked.connect(self.parent().set_central_widget)
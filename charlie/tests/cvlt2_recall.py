@@ -39,12 +39,13 @@ except ImportError:
     from PyQt4 import QtGui, QtCore
 
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.data as data
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
 from charlie.tests.cvlt2 import semantic_clustering, serial_clustering,\
     clusters
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'cvlt2_recall'
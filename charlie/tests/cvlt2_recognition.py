@@ -58,7 +58,9 @@ output_format = [
     ('type', str),
     ('ans', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 word_pos = (0,-100)
 types = 'utuptputtupputupttpputpuptututpppuutpttpuutputpu'
@@ -125,7 +127,7 @@ def trial_method(screen, instructions, trial_info):
     screen.wipe(q.get_rect(center=word_pos))
 
     # return trial outcome
-    trial_info = tuple(list(trial_info) + [rsp, rt])
+    trial_info = tuple(list(trial_info) + [rsp, rt] + events.response_times())
 
     return trial_info
 
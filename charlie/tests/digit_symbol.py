@@ -37,13 +37,14 @@ San Antonio, TX: The Psychological Corporation.
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.audio as audio
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 test_name = 'digit_symbol'
 output_format = [
@@ -56,7 +57,9 @@ output_format = [
     ('ans', str),
     ('f', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 max_time = 90
 practice_order = [(2,2), (6,6),
@@ -185,7 +188,8 @@ def trial_method(screen, instructions, trial_info):
         screen.wipe(r)
     
         # return trial outcome
-        trial_info = tuple(list(trial_info) + [rsp, rt])
+        trial_info = tuple(list(trial_info) + [rsp, rt] +
+                           events.response_times())
         return trial_info
 
     else:
@@ -213,49 +217,44 @@ def trial_method(screen, instructions, trial_info):
         # set up trials
         screen.wipe()
         events.clear()
-        current_time = 0
-        new_trial = True
         keys = [276, 275]
-        clock = events.Clock()
-        while current_time < max_time:
+        end = events.now() + max_time
+        while control:
     
-            current_time += (clock.tick_busy_loop()/1000.)
+            _, _, phase, trialn, digit, symbol, ans, f = control.pop(0)
+            screen.update_image_zones()
+            img = screen.images[f]
+            p = labels, [visual.DEFAULT_TEXT_COLOUR] * len(labels)
+            screen.change_word_colour(*p)
+            screen.change_key_colour(('l','r'), ('',''))
+            screen.change_word_colour(list('123456789'),
+                                    [visual.DEFAULT_TEXT_COLOUR] * 9)
+            screen.blit_image(img, (0, 0))
+            q, r = screen.blit_text(str(digit), (0,100), update=False,
+                                    font=screen.font2)
+            onset = screen.update()
     
-            if new_trial:
-    
-                new_trial = False
-                trial_clock = events.Clock()
-                _, _, phase, trialn, digit, symbol, ans, f = control.pop(0)
-                screen.update_image_zones()
-                img = screen.images[f]
-                p = labels, [visual.DEFAULT_TEXT_COLOUR] * len(labels)
-                screen.change_word_colour(*p)
-                screen.change_key_colour(('l','r'), ('',''))
-                screen.change_word_colour(list('123456789'),
-                                        [visual.DEFAULT_TEXT_COLOUR] * 9)
-                screen.blit_image(img, (0, 0))
-                q, r = screen.blit_text(str(digit), (0,100), update=False,
-                                        font=screen.font2)
-                screen.update()
-    
-            k = events.poll_for_valid_keydown(keys, 'key')
+            k = events.wait_for_valid_keydown_until(keys, 'key', end)
     
             if k == 'EXIT':
                 return 'EXIT'
             
-            elif k:
-                rt = trial_clock.tick_busy_loop()
-                new_trial = True
-                rsp = dict(zip(keys,labels))[k]
-                rspk = dict(zip(keys,('l', 'r')))[k]
-                screen.change_word_colour(rsp, visual.BLUE)
-                screen.change_key_colour(rspk, 'b', update=False)
-                screen.update()
-                # screen.wipe(img.get_rect(center=(0,0)), update=False)
-                # screen.wipe(r)
-                trial_info = (proband_id, test_name, phase, trialn, digit,
-                              symbol, ans, f, rsp, rt)
-                _data.append(trial_info)
+            elif k is None:
+                break
+
+            k, t = k
+            rt = events.record_response(t, onset)
+            rsp = dict(zip(keys,labels))[k]
+            rspk = dict(zip(keys,('l', 'r')))[k]
+            screen.change_word_colour(rsp, visual.BLUE)
+            screen.change_key_colour(rspk, 'b', update=False)
+            screen.update()
+            # screen.wipe(img.get_rect(center=(0,0)), update=False)
+            # screen.wipe(r)
+            trial_info = tuple([proband_id, test_name, phase, trialn, digit,
+                                symbol, ans, f, rsp, rt] +
+                               events.response_times())
+            _data.append(trial_info)
     
             events.wait(events.DEFAULT_ITI_NOFEEDBACK)
     
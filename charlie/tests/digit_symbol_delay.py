@@ -27,12 +27,13 @@ schizophrenia. Am. J. Med. Genet. B. Neuropsychiatr. Genet., 44B(2):242-249.
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'digit_symbol_delay'
@@ -43,7 +44,9 @@ output_format = [
     ('ans', str),
     ('f', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 symbols = [6, 7, 4, 8, 5, 1, 9, 2, 3]
 
@@ -87,7 +90,8 @@ def trial_method(screen, instructions, trial_info):
     if mouse_click == 'EXIT':
         return 'EXIT'
     rsp, rt = mouse_click
-    trial_info = tuple(list(trial_info) + [rsp + 1, rt])
+    trial_info = tuple(list(trial_info) + [rsp + 1, rt] +
+                       events.response_times())
 
     return trial_info
 
@@ -39,13 +39,14 @@ standardization for use in neurocognitive studies. J. Neurosci. Methods,
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
 from charlie.tools.instructions import quickfix as qf
+pandas = lazy.lazy_import('pandas')
 
 test_name = 'emotion_recognition'
 stim_order = [23, 9, 18, 12, 14, 5, 1, 35, 31, 13, 10, 0, 30, 38, 36, 6, 15,
@@ -61,7 +62,9 @@ output_format = [
     ('salience', str),
     ('f', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 black_bg = True
 
@@ -123,7 +126,8 @@ def trial_method(screen, instructions, trial_info):
     events.wait(events.DEFAULT_ITI_NOFEEDBACK)
     screen.wipe(img.get_rect(center=img_pos))
 
-    trial_info = tuple(list(trial_info) + [labels[i], rspt])
+    trial_info = tuple(list(trial_info) + [labels[i], rspt] +
+                       events.response_times())
     return trial_info
 
 
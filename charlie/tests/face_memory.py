@@ -32,12 +32,13 @@ performance and ”effort”. Brain Cogn., 33:388-414.
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 
 output_format = [
@@ -48,7 +49,9 @@ output_format = [
     ('f', str),
     ('ans', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 test_name = 'face_memory'
 stim_order = [15, 19, 31, 37, 33, 11, 28, 16, 6, 23, 20, 17, 39, 32, 22, 36, 5,
@@ -108,7 +111,7 @@ def trial_method(screen, instructions, trial_info):
         screen.update()
         events.wait(4)
 
-        trial_info = tuple(list(trial_info) + ['n/a', 0])
+        trial_info = tuple(list(trial_info) + ['n/a', 0, None, None])
 
     else:
 
@@ -147,7 +150,8 @@ def trial_method(screen, instructions, trial_info):
         screen.wipe(img.get_rect(center=img_pos))
 
         # return trial outcome
-        trial_info = tuple(list(trial_info) + [rsp, rt])
+        trial_info = tuple(list(trial_info) + [rsp, rt] +
+                           events.response_times())
 
     return trial_info
 
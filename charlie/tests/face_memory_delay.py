@@ -28,12 +28,13 @@ performance and ”effort”. Brain Cogn., 33:388-414.
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 output_format = [
     ('proband_id', str),
@@ -43,7 +44,9 @@ output_format = [
     ('f', str),
     ('ans', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 test_name = 'face_memory_delay'
 stim_order = [34, 12, 28, 37, 22, 17, 2, 13, 32, 23, 8, 20, 14, 38, 7, 31, 26,
@@ -117,7 +120,7 @@ def trial_method(screen, instructions, trial_info):
     screen.wipe(img.get_rect(center=img_pos))
 
     # return trial outcome
-    trial_info = tuple(list(trial_info) + [rsp, rt])
+    trial_info = tuple(list(trial_info) + [rsp, rt] + events.response_times())
 
     return trial_info
 
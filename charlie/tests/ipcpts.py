@@ -43,13 +43,14 @@ __version__ = 1.1
 __author__ = 'Sam Mathias'
 
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.audio as audio
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'ipcpts'
@@ -64,7 +65,9 @@ output_format = [
     ('symbol2', str),
     ('symbol3', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 presentation_time = 1
 wait_time = .5
@@ -160,12 +163,11 @@ def trial_method(screen, instructions, trial_info):
     # set up trials
     keys = [32]  # the space bar
     if phase == 'practice':
-        pt = presentation_time * 2000
-        wt = wait_time * 2000
+        pt = presentation_time * 2
+        wt = wait_time * 2
     else:
-        pt = presentation_time * 1000
-        wt = wait_time * 1000
-    clock = events.Clock()
+        pt = presentation_time
+        wt = wait_time
 
     # run trials
     _data = []
@@ -174,42 +176,47 @@ def trial_method(screen, instructions, trial_info):
     while control:
         trial_info = control.pop(0)
         events.clear()
-        current_time = 0
-        symbols_on = False
         rsp = no
         rt = 0
+        times = [None, None]
         screen.reset_zones()
 
-        while current_time < pt + wt:
+        # images = [screen.images[a] for a in trial_info[-3:]]
+        images = trial_info[-3:]
+        screen.create_image_zones(images, 150, -50)
+        screen.create_keyboard_key_zones(['s'], 0, 250)
+        screen.update_image_zones(update=False)
+        screen.change_key_colour('s', '', update=False)
+        onset = screen.update()
+        symbols_on = True
 
-            current_time += clock.tick_busy_loop()
+        while 1:
 
-            if current_time < pt and not symbols_on:
+            if symbols_on:
+                deadline = onset + pt
+            else:
+                deadline = onset + pt + wt
+            k = events.wait_for_valid_keydown_until(keys, 'key', deadline)
 
-                # images = [screen.images[a] for a in trial_info[-3:]]
-                images = trial_info[-3:]
-                screen.create_image_zones(images, 150, -50)
-                screen.create_keyboard_key_zones(['s'], 0, 250)
-                screen.update_image_zones(update=False)
-                screen.change_key_colour('s', '', update=False)
-                screen.update()
-                symbols_on = True
+            if k == 'EXIT':
+                return 'EXIT'
 
-            elif current_time > pt and symbols_on:
+            elif k is None and symbols_on:
 
                 screen.wipe([t[1] for t in screen.imagezones.values()],
                             prc=False)
+                screen.record_frame('offset', deadline, events.onset_time())
                 symbols_on = False
 
-            k = events.poll_for_valid_keydown(keys, 'key')
-    
-            if k == 'EXIT':
-                return 'EXIT'
-            
-            elif k and rsp == 'No':
+            elif k is None:
+
+                break
+
+            elif rsp == 'No':
 
                 rsp = yes
-                rt = current_time
+                rt = events.record_response(k[1], onset)
+                times = events.response_times()
                 if trial_info[2] == 'practice':
                     if trial_info[4] == 3:
                         screen.change_key_colour('s', 'g', update=False)
@@ -227,7 +234,7 @@ def trial_method(screen, instructions, trial_info):
                 screen.change_key_colour('s', '', update=False)
                 screen.update()
 
-        trial_info = tuple(list(trial_info) + [rsp, rt])
+        trial_info = tuple(list(trial_info) + [rsp, rt] + times)
         _data.append(trial_info)
     return _data
 
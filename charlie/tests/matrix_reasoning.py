@@ -26,13 +26,14 @@ San Antonio, TX: The Psychological Corporation.
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
 import charlie.tools.audio as audio
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'matrix_reasoning'
@@ -45,7 +46,9 @@ output_format = [
     ('array', str),
     ('ans', int),
     ('rsp', int),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 answers = [1, 3, 1, 3, 2, 0, 0, 2, 4, 4, 4, 1, 2, 0, 1, 3, 2, 0, 0, 3, 4, 4, 1,
            1, 0, 4, 3, 2, 2, 3, 0, 3, 1, 2, 4]
@@ -127,50 +130,46 @@ def trial_method(screen, instructions, trial_info):
     screen.flip()
 
     # set up timer
-    clock = events.Clock()
-    time_left = 120000
+    onset = events.onset_time()
+    time_limit = 120
     
-    while time_left > 0:
+    mouse_click = events.wait_for_valid_mouse_click_until(
+        screen, 1, onset + time_limit
+    )
         
-        mouse_click = events.poll_for_valid_mouse_click(screen, 1)
+    if mouse_click == 'EXIT':
+        return 'EXIT'
         
-        if mouse_click == 'EXIT':
-            return 'EXIT'
-        
-        elif mouse_click is None:
-            pass
-        
-        else:
-            rsp = mouse_click
-
-            # if this is the practice trial, do some extra stuff
-            if phase == 'practice':
-                while rsp != ans:
-                    audio.play_feedback(False)
-                    screen.blit_rectangle(screen.zones[rsp], visual.RED,
-                                          alpha=100)
-                    screen.flip()
-                    rsp, rt = events.wait_for_valid_mouse_click(screen,
-                                                                      1)
-                audio.play_feedback(True)
-                screen.blit_rectangle(screen.zones[rsp], visual.GREEN,
+    elif mouse_click is not None:
+        rsp, t = mouse_click
+        rt = events.record_response(t, onset)
+        times = events.response_times()
+
+        # if this is the practice trial, do some extra stuff
+        if phase == 'practice':
+            while rsp != ans:
+                audio.play_feedback(False)
+                screen.blit_rectangle(screen.zones[rsp], visual.RED,
                                       alpha=100)
                 screen.flip()
-                events.wait(events.DEFAULT_ITI_FEEDBACK)
+                rsp, _ = events.wait_for_valid_mouse_click(screen, 1)
+            audio.play_feedback(True)
+            screen.blit_rectangle(screen.zones[rsp], visual.GREEN,
+                                  alpha=100)
+            screen.flip()
+            events.wait(events.DEFAULT_ITI_FEEDBACK)
         
-            # if a regular trial
-            else:
-                screen.blit_rectangle(screen.zones[rsp], visual.BLUE,
-                                      alpha=100,update=False)
-                screen.update()
-                events.wait(events.DEFAULT_ITI_NOFEEDBACK)
+        # if a regular trial
+        else:
+            screen.blit_rectangle(screen.zones[rsp], visual.BLUE,
+                                  alpha=100,update=False)
+            screen.update()
+            events.wait(events.DEFAULT_ITI_NOFEEDBACK)
         
-            return tuple(list(trial_info) + [rsp, 120000-time_left])
-    
-        time_left -= clock.tick_busy_loop()
+        return tuple(list(trial_info) + [rsp, rt] + times)
     
     print 'time up'
-    return tuple(list(trial_info) + [999, 999])
+    return tuple(list(trial_info) + [999, 999, None, None])
 
 
 def summary_method(data_obj, instructions):
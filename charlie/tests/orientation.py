@@ -31,11 +31,12 @@ __version__ = 1.0
 __author__ = 'Sam Mathias'
 
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 test_name = 'orientation'
 output_format = [
@@ -48,8 +49,10 @@ output_format = [
     ('dposx', int),
     ('dposy', int),
     ('rsp', int),
-    ('rt', int),
-    ('total_time', int)
+    ('rt', float),
+    ('total_time', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 phases = ('first', 'last')
 positions = [
@@ -120,8 +123,7 @@ def trial_method(screen, instructions, trial_info):
     f1 = lambda x: data.pj(path, '%s_s.png' % str(x))
     f2 = lambda x: data.pj(path, '%s_c.png' % str(9 - x))
 
-    trial_clock = events.Clock()
-    total_time = trial_clock.tick_busy_loop()
+    start = events.now()
 
     trialn = -1
     size = -1
@@ -151,9 +153,9 @@ def trial_method(screen, instructions, trial_info):
             else:
                 r, rt = mouse_click
 
-            total_time += trial_clock.tick_busy_loop()
-            t = (proband_id, test_name, phase, size, x, y, dpos[0], dpos[1], r,
-                rt, total_time)
+            total_time = (events.now() - start) * 1000.
+            t = tuple([proband_id, test_name, phase, size, x, y, dpos[0],
+                       dpos[1], r, rt, total_time] + events.response_times())
             trial_data.append(t)
 
             if r == 0:
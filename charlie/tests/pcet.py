@@ -36,13 +36,14 @@ forms for repeat administration. Arch. Clin. Neuropsych., 19: 191-201.
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
 import charlie.tools.audio as audio
+pandas = lazy.lazy_import('pandas')
 
 test_name = 'pcet'
 img_pos = (0, -150)
@@ -61,7 +62,9 @@ output_format = [
     ('f3', str),
     ('f4', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 
 details = [
@@ -247,7 +250,8 @@ def trial_method(screen, instructions, trial_info):
     audio.play_feedback(corr)
     events.wait(events.DEFAULT_ITI_FEEDBACK)
     screen.wipe()
-    trial_info = tuple(list(trial_info) + [rsp, rspt])
+    trial_info = tuple(list(trial_info) + [rsp, rspt] +
+                       events.response_times())
     return trial_info
 
 
@@ -43,13 +43,14 @@ Version history:
 __version__ = 1.1
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.audio as audio
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'scap'
@@ -63,7 +64,9 @@ output_format = [
     ('array_f', str),
     ('probe_f', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 array_duration = 2
 retention_interval = 4
@@ -151,21 +154,17 @@ def trial_method(screen, instructions, trial_info):
     # show array
     array = screen.images[array_f]
     img, rect = screen.blit_image(array, img_pos, update=False)
-    screen.update()
-
-    # wait
-    events.wait(array_duration)
+    screen.present(array_duration, 'array')
 
     # remove array
     retention = screen.images[retention_image]
     img, rect = screen.blit_image(retention, img_pos, update=False)
-    screen.update()
-    events.wait(retention_interval)
+    screen.present(retention_interval, 'retention')
 
     # show
     probe = screen.images[probe_f]
     img, rect = screen.blit_image(probe, img_pos, update=False)
-    screen.update()
+    screen.present(label='probe')
 
     # wait for a response
     keys = [276, 275]
@@ -194,7 +193,7 @@ def trial_method(screen, instructions, trial_info):
         events.wait(events.DEFAULT_ITI_NOFEEDBACK)
 
     # return trial outcome
-    trial_info = tuple(list(trial_info) + [rsp, rt])
+    trial_info = tuple(list(trial_info) + [rsp, rt] + events.response_times())
 
     return trial_info
 
@@ -49,13 +49,14 @@ __version__ = 1.0
 __author__ = 'Sam Mathias'
 
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.audio as audio
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 test_name = 'stroop'
 output_format = [
@@ -67,7 +68,9 @@ output_format = [
     ('f', str),
     ('ans', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 prac_answers = [1, 0, 1, 1]
 stim_order = [98, 53, 9, 10, 103, 95, 31, 32, 46, 42, 40, 100, 84, 21, 68, 86,
@@ -183,7 +186,7 @@ def trial_method(screen, instructions, trial_info):
         events.wait(events.DEFAULT_ITI_FEEDBACK)
         screen.wipe(img.get_rect(center=img_pos))
 
-    trial_info = tuple(list(trial_info) + [rsp, rt])
+    trial_info = tuple(list(trial_info) + [rsp, rt] + events.response_times())
 
     return trial_info
 
@@ -52,13 +52,14 @@ __version__ = 1.1
 __author__ = 'Sam Mathias'
 
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.audio as audio
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 test_name = 'switching'
 output_format = [
@@ -74,7 +75,9 @@ output_format = [
     ('f', str),
     ('ans', str),
     ('rsp', str),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 answers = {
     'practice': (
@@ -241,7 +244,7 @@ def trial_method(screen, instructions, trial_info):
         events.wait(events.DEFAULT_ITI_FEEDBACK)
         screen.wipe(img.get_rect(center=img_pos))
 
-    trial_info = tuple(list(trial_info) + [rsp, rt])
+    trial_info = tuple(list(trial_info) + [rsp, rt] + events.response_times())
 
     return trial_info
 
@@ -42,7 +42,7 @@ B of the Trail Making Test. J Clin Psychol, 43(4):402–409.
 __version__ = 1.1
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 try:
     from PySide import QtGui, QtCore
 except ImportError:
@@ -50,6 +50,7 @@ except ImportError:
 import charlie.tools.data as data
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'trails'
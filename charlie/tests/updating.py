@@ -42,13 +42,14 @@ __version__ = 1.2
 __author__ = 'Sam Mathias'
 
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.visual as visual
 import charlie.tools.data as data
 import charlie.tools.events as events
 import charlie.tools.summaries as summaries
 import charlie.tools.audio as audio
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'updating'
@@ -63,7 +64,9 @@ output_format = [
     ('moves', str),
     ('marginalpositions', str),
     ('rsp', int),
-    ('rt', int)
+    ('rt', float),
+    ('onset_time', float),
+    ('rsp_time', float)
 ]
 
 study_duration = 2
@@ -277,7 +280,7 @@ def trial_method(screen, instructions, trial_info):
         screen.blit_rectangle(screen.zones[i], visual.BLUE, alpha=100)
         screen.update()
         events.wait(events.DEFAULT_ITI_NOFEEDBACK)
-    trial_info = tuple(list(trial_info) + [i, rt])
+    trial_info = tuple(list(trial_info) + [i, rt] + events.response_times())
     return trial_info
 
 timeout = 120
@@ -48,7 +48,7 @@ __version__ = 1.0
 __author__ = 'Sam Mathias'
 
 
-import pandas
+import charlie.tools.lazy as lazy
 try:
     from PySide import QtGui, QtCore
 except ImportError:
@@ -56,6 +56,7 @@ except ImportError:
 import charlie.tools.data as data
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'verbal_fluency'
@@ -41,7 +41,7 @@ letter-number sequencing, it reflects 33% correct.
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import numpy as np
 try:
     from PySide import QtGui, QtCore
@@ -49,6 +49,7 @@ except ImportError:
     from PyQt4 import QtGui, QtCore
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
+pandas = lazy.lazy_import('pandas')
 
 
 test_name = 'verbal_working_memory'
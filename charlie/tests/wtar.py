@@ -27,7 +27,7 @@ The Psychological Corporation
 __version__ = 1.0
 __author__ = 'Sam Mathias'
 
-import pandas
+import charlie.tools.lazy as lazy
 import charlie.tools.data as data
 import charlie.tools.summaries as summaries
 import charlie.tools.batch as batch
@@ -36,6 +36,7 @@ try:
 except ImportError:
     from PyQt4 import QtGui, QtCore
 import charlie.tools.summaries as summaries
+pandas = lazy.lazy_import('pandas')
 
 test_name = 'wtar'
 
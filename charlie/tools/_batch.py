@@ -8,8 +8,6 @@ Created on Tue Jan  6 16:15:06 2015
 """
 
 import importlib
-import os
-from os.path import join as pj
 import sys
 import charlie.tools.instructions as instructions
 import charlie.tools.data as data
@@ -86,6 +84,7 @@ def run_a_test(test_name, batch_mode=False):
             _ = MainWindow(data_obj, instr)
     #            sys.exit(app.exec_())
             app.exec_()
+        data.flush()
 
     # set up a normal pygame session
     else:
@@ -100,64 +99,70 @@ def run_a_test(test_name, batch_mode=False):
         else:
             visual.BG_COLOUR = visual.LIGHT_GREY
             visual.DEFAULT_TEXT_COLOUR = visual.BLACK
-        p = pj(data.VISUAL_PATH, test_name)
-        imgfs = ['.png', '.jpg', '.gif', '.bmp']
-        if os.path.exists(p):
-            print '---Loading visual stimuli.'
-            imgs = [f for f in data.ld(p) if f[-4:].lower() in imgfs]
-            [screen.load_image(pj(p, i)) for i in imgs]
+        print '---Loading visual stimuli in the background.'
+        preloader = screen.preload_stimuli(test_name, data_obj.control)
 
         # run trials
-        while data_obj.control:
-
-            print '---Running new trial.'
-            t = data_obj.control.pop(0)
-            trial_method = getattr(mod, 'trial_method')
-            trial_info = trial_method(screen, instr, t)
-
-            # record the outcome of the trial
-            if trial_info != 'EXIT':
-
-                if type(trial_info) == list:
-                    data_obj.data += trial_info
-                else:
-                    data_obj.data.append(trial_info)
-
-                if proband_id != 'TEST':
-                    print '---Saving and writing csv.'
-                    data_obj.update()
-                    data_obj.to_csv()
-
-                # check for a stopping rule
-                if hasattr(mod, 'stopping_rule'):
-                    stopping_rule = getattr(mod, 'stopping_rule')
-                    print '--Testing stopping rule ...',
-                    if stopping_rule(data_obj):
-                        print 'failed.'
-                        data_obj.control = []
+        try:
+            while data_obj.control:
+
+                print '---Running new trial.'
+                t = data_obj.control.pop(0)
+                preloader.advance()
+                trial_method = getattr(mod, 'trial_method')
+                trial_info = trial_method(screen, instr, t)
+                screen.end_frames(False)
+                timing = screen.frame_report()
+                if timing:
+                    data_obj.to_log('frame timing: %s' % timing)
+
+                # record the outcome of the trial
+                if trial_info != 'EXIT':
+
+                    if type(trial_info) == list:
+                        data_obj.data += trial_info
                     else:
-                        print 'passed.'
+                        data_obj.data.append(trial_info)
 
-                # check for remaining trials
-                if not data_obj.control:
-                    print '---No more trials in the queue.'
-                    data_obj.test_done = True
                     if proband_id != 'TEST':
-                        print '---Computing summary stats.'
-                        summary_method = getattr(mod, 'summary_method')
-                        data_obj.to_localdb(summary_method, instr)
-
-            # premature exit
-            else:
+                        print '---Saving and writing csv.'
+                        data_obj.update()
+                        data_obj.to_csv()
+
+                    # check for a stopping rule
+                    if hasattr(mod, 'stopping_rule'):
+                        stopping_rule = getattr(mod, 'stopping_rule')
+                        print '--Testing stopping rule ...',
+                        if stopping_rule(data_obj):
+                            print 'failed.'
+                            data_obj.control = []
+                        else:
+                            print 'passed.'
+
+                    # check for remaining trials
+                    if not data_obj.control:
+                        print '---No more trials in the queue.'
+                        data_obj.test_done = True
+                        if proband_id != 'TEST':
+                            print '---Computing summary stats.'
+                            summary_method = getattr(mod, 'summary_method')
+                            data_obj.to_localdb(summary_method, instr)
+                        data.flush()
+
+                # premature exit
+                else:
 
-                print "---'EXIT' detected."
-                if not batch_mode:
-                    screen.kill()
-                    break  # act as if the session is over
+                    print "---'EXIT' detected."
+                    data.flush()
+                    if not batch_mode:
+                        screen.kill()
+                        break  # act as if the session is over
 
-                else:
-                    screen.kill()
-                    return prompt(batch_mode), data_obj
+                    else:
+                        screen.kill()
+                        return prompt(batch_mode), data_obj
+        finally:
+            preloader.stop()
     print '---All trials done.\n---------'
     print 'TEST OVER'
     print '---------'
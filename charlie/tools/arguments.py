@@ -49,6 +49,46 @@ def get_parser():
         '-a', '--backup', choices=['', 'sftp'], default='',
         help="Backup method (e.g., 'sftp')"
     )
+    parser.add_argument(
+        '-s', '--script', default='',
+        help='Response script for headless runs (if omitted, responses are '
+             'random).'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help='Random seed for headless runs.'
+    )
+    parser.add_argument(
+        '-n', '--probands', type=int, default=1000,
+        help='Number of synthetic probands for load tests.'
+    )
+    parser.add_argument(
+        '--keep', action='store_true',
+        help='Keep the temporary data written by load tests, benchmarks and '
+             'headless runs.'
+    )
+    parser.add_argument(
+        '-o', '--output_dir', default=None,
+        help='Directory headless runs write their data to, which is kept '
+             '(default: a temporary directory).'
+    )
+    parser.add_argument(
+        '--baseline', default='default',
+        help='Name of the baseline benchmarks are compared against.'
+    )
+    parser.add_argument(
+        '--update_baseline', action='store_true',
+        help='Save benchmark results as the new baseline.'
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int, default=None,
+        help='Number of worker processes for rescoring (default: one per '
+             'CPU).'
+    )
+    parser.add_argument(
+        '--startup_report', action='store_true',
+        help='Print how long start-up and deferred imports took.'
+    )
     return parser
 
 
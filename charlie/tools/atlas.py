@@ -0,0 +1,178 @@
+"""
+Pre-compiled stimulus atlases.
+
+Decoding PNG and BMP files is the slowest part of getting an image onto the
+screen. An atlas holds the raw RGBA pixels of every image in one test's folder
+of visual stimuli, together with an index of where each image starts and how
+big it is. Atlases are compiled once, offline, by running this module:
+
+    python -m charlie.tools.atlas [test_name ...]
+
+At run time an atlas is memory-mapped and images are created straight from
+the mapped pixels with pygame.image.frombuffer, so nothing is decoded. Each
+index entry records the size and modification time of the source file, which
+only costs an os.stat to check, and images whose file has changed since the
+atlas was compiled are decoded from disk as usual.
+"""
+
+import cPickle
+import mmap
+import os
+import struct
+import sys
+import threading
+import pygame
+import charlie.tools.data as data
+import charlie.tools.misc as misc
+
+
+ATLAS_PATH = data.pj(data.STIM_PATH, 'atlases')
+ATLAS_EXT = '.atlas'
+ATLAS_MAGIC = 'CATL'
+ATLAS_VERSION = 2
+ATLAS_HEADER = struct.Struct('<4sII')  # magic, version, length of index
+_atlases = {}
+_lock = threading.Lock()
+
+
+def atlas_filename(test_name):
+    """
+    Returns the path of the atlas for the given test.
+    """
+    return data.pj(ATLAS_PATH, test_name + ATLAS_EXT)
+
+
+def stamp(f):
+    """
+    Returns the size and modification time (in whole seconds) of the file at
+    path f, which change whenever the file does.
+    """
+    st = os.stat(f)
+    return st.st_size, int(st.st_mtime)
+
+
+def compile_atlas(test_name):
+    """
+    Decodes every image in the test's folder of visual stimuli and writes
+    their pixels to the test's atlas. Returns the number of images compiled,
+    or None if the test has no visual stimuli.
+    """
+    p = data.pj(data.VISUAL_PATH, test_name)
+    if not os.path.isdir(p):
+        return None
+    files = sorted(f for f in data.ld(p) if misc.is_imgfile(data.pj(p, f)))
+    index = {}
+    blocks = []
+    offset = 0
+    for f in files:
+        surface = pygame.image.load(data.pj(p, f))
+        if surface.get_colorkey() is not None:
+            # bake the transparent colour into the alpha channel
+            keyed = surface
+            surface = pygame.Surface(keyed.get_size(), pygame.SRCALPHA, 32)
+            surface.fill((0, 0, 0, 0))
+            surface.blit(keyed, (0, 0))
+        pixels = pygame.image.tostring(surface, 'RGBA')
+        index[f] = offset, surface.get_size(), stamp(data.pj(p, f))
+        blocks.append(pixels)
+        offset += len(pixels)
+    s = cPickle.dumps(index, cPickle.HIGHEST_PROTOCOL)
+    if not os.path.exists(ATLAS_PATH):
+        os.makedirs(ATLAS_PATH)
+    filename = atlas_filename(test_name)
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fileobj:
+        fileobj.write(ATLAS_HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION, len(s)))
+        fileobj.write(s)
+        for pixels in blocks:
+            fileobj.write(pixels)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp, filename)
+    return len(files)
+
+
+def compile_all(test_names=None):
+    """
+    Compiles the atlases of the given tests, or of every test with a folder of
+    visual stimuli.
+    """
+    if not test_names:
+        test_names = sorted(t for t in data.ld(data.VISUAL_PATH) if
+                            os.path.isdir(data.pj(data.VISUAL_PATH, t)))
+    for test_name in test_names:
+        n = compile_atlas(test_name)
+        if n is None:
+            print '---No visual stimuli for %s.' % test_name
+        else:
+            print '---Compiled %i images for %s.' % (n, test_name)
+
+
+class Atlas:
+
+    """
+    A memory-mapped atlas file. Images are returned as surfaces sharing
+    memory with the map, so they should be copied (e.g., with convert_alpha)
+    before being kept around.
+    """
+
+    def __init__(self, filename):
+        self.fileobj = open(filename, 'rb')
+        self.map = mmap.mmap(self.fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n = ATLAS_HEADER.unpack(self.map[:ATLAS_HEADER.size])
+        if magic != ATLAS_MAGIC or version != ATLAS_VERSION:
+            raise ValueError('%s is not a version %i atlas' % (filename,
+                                                               ATLAS_VERSION))
+        self.start = ATLAS_HEADER.size + n
+        self.index = cPickle.loads(self.map[ATLAS_HEADER.size:self.start])
+
+    def surface(self, name, f):
+        """
+        Returns the surface for the image called name, or None if the atlas
+        does not contain it or the file at path f has changed since the atlas
+        was compiled.
+        """
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        offset, size, file_stamp = entry
+        if stamp(f) != file_stamp:
+            return None
+        w, h = size
+        pixels = buffer(self.map, self.start + offset, w * h * 4)
+        return pygame.image.frombuffer(pixels, size, 'RGBA')
+
+
+def get_atlas(test_name):
+    """
+    Returns the atlas for the given test, opening it the first time it is
+    needed, or None if it has not been compiled or cannot be read.
+    """
+    with _lock:
+        if test_name not in _atlases:
+            try:
+                _atlases[test_name] = Atlas(atlas_filename(test_name))
+            except (EnvironmentError, ValueError, struct.error,
+                    cPickle.UnpicklingError):
+                _atlases[test_name] = None
+        return _atlases[test_name]
+
+
+def load(f):
+    """
+    Returns an unconverted surface for the image at path f. The pixels come
+    from the atlas of the image's folder if there is an up-to-date one, and
+    are decoded from the file otherwise.
+    """
+    p, name = os.path.split(os.path.abspath(f))
+    if os.path.dirname(p) == os.path.abspath(data.VISUAL_PATH):
+        atlas = get_atlas(os.path.basename(p))
+        if atlas is not None:
+            surface = atlas.surface(name, f)
+            if surface is not None:
+                return surface
+    return pygame.image.load(f)
+
+
+if __name__ == '__main__':
+    compile_all(sys.argv[1:])
@@ -6,34 +6,159 @@ Created on Thu Jan 15 10:09:59 2015
 @author: smathias
 """
 
+import os
 from os.path import join as pj
+import threading
+import numpy as np
+import pygame
 import pygame.mixer as mixer
+import pygame.sndarray as sndarray
+import charlie.tools.events as events
 from charlie.tools.data import AUDIO_PATH
 
 
-def play_sound(f):
+MIXER_FREQUENCY = 44100  # all the wav files are 16-bit, 44.1 kHz
+MIXER_SIZE = -16
+MIXER_CHANNELS = 2
+MIXER_BUFFER = 256  # samples; about 6 ms at 44.1 kHz
+NUM_CHANNELS = 8
+FEEDBACK_CHANNEL = 0  # reserved, so other sounds never delay feedback
+FEEDBACK_FILES = 'Wrong.wav', 'Correct.wav'
+
+_sounds = {}  # absolute path : decoded Sound
+_lock = threading.Lock()
+_mixer = {'init': None,  # mixer settings the sounds were decoded for
+          'unavailable': False}  # init failed; not retried every trial
+
+
+def pre_init():
+    """
+    Sets up the mixer with a small buffer. Must be called before
+    pygame.init(), which otherwise initialises the mixer with a large default
+    buffer.
+    """
+    mixer.pre_init(MIXER_FREQUENCY, MIXER_SIZE, MIXER_CHANNELS, MIXER_BUFFER)
+
+
+def init():
     """
-    Plays the wav file specified by f.
+    Initialises the mixer if necessary, reserves a channel for feedback, and
+    decodes the feedback sounds, so that the first feedback is as quick as
+    the rest. Returns False if there is no audio device.
     """
     if mixer.get_init() is None:
+        if _mixer['unavailable']:
+            return False
+        pre_init()
+        try:
+            mixer.init()
+        except pygame.error, e:
+            print '---mixer unavailable: %s' % e
+            _mixer['unavailable'] = True
+            return False
         print '---mixer intialised'
-        mixer.init()
-    
-    mixer.Sound(f).play()
+    if _mixer['init'] != mixer.get_init():
+        with _lock:
+            _sounds.clear()
+        mixer.set_num_channels(NUM_CHANNELS)
+        mixer.set_reserved(FEEDBACK_CHANNEL + 1)
+        _mixer['init'] = mixer.get_init()
+        for f in FEEDBACK_FILES:
+            get_sound(pj(AUDIO_PATH, f))
+    return True
+
+
+def get_sound(f):
+    """
+    Returns the Sound for the wav file specified by f, decoding it the first
+    time it is needed.
+    """
+    key = os.path.abspath(f)
+    with _lock:
+        sound = _sounds.get(key)
+    if sound is None:
+        sound = mixer.Sound(key)
+        with _lock:
+            sound = _sounds.setdefault(key, sound)
+    return sound
+
+
+def play_sound(f):
+    """
+    Plays the wav file specified by f, or does nothing if there is no audio
+    device.
+    """
+    if not init():
+        return
+    get_sound(f).play()
 
 
 def play_feedback(corr):
     """
-    Plays audio feedback. corr is a bool where False means incorrect and True
-    means correct.
+    Plays audio feedback on the reserved feedback channel. corr is a bool
+    where False means incorrect and True means correct. Does nothing if there
+    is no audio device.
     """
-    if mixer.get_init() is None:
-        print '---mixer intialised'
-        mixer.init()
-    
-    f = pj(AUDIO_PATH, ['Wrong.wav', 'Correct.wav'][corr])
-    sound = mixer.Sound(f)
-    sound.play()
+    if not init():
+        return
+    f = pj(AUDIO_PATH, FEEDBACK_FILES[corr])
+    mixer.Channel(FEEDBACK_CHANNEL).play(get_sound(f))
+
+
+class Timeline:
+
+    """
+    A list of wav files mixed into a single Sound in which each file starts a
+    fixed interval (soa, in seconds) after the previous one. The onsets are
+    fixed to the sample within one mixer stream, so they do not depend on when
+    a timer fires or how long a file takes to decode, and the whole list
+    starts with one call to play.
+    """
+
+    def __init__(self, files, soa):
+        """
+        Decodes the files (once; see get_sound) and mixes them. Raises
+        RuntimeError if there is no audio device, as the list cannot be
+        presented silently.
+        """
+        if not init():
+            raise RuntimeError('no audio device to play %s' % ', '.join(
+                os.path.basename(f) for f in files))
+        self.files = list(files)
+        self.frequency = mixer.get_init()[0]
+        arrays = [sndarray.array(get_sound(f)) for f in self.files]
+        step = int(round(soa * self.frequency))
+        self.offsets = [i * step for i in xrange(len(arrays))]
+        n = max(o + len(a) for o, a in zip(self.offsets, arrays))
+        dtype = arrays[0].dtype
+        mix = np.zeros((n, ) + arrays[0].shape[1:], np.int32)
+        for o, a in zip(self.offsets, arrays):
+            mix[o:o + len(a)] += a
+        lim = np.iinfo(dtype)
+        mix = np.clip(mix, lim.min, lim.max).astype(dtype)
+        self.sound = sndarray.make_sound(mix)
+        self.start_time = None
+
+    def play(self):
+        """
+        Starts playing the list. Returns the estimated time (see events.now)
+        at which the first sample reaches the audio device. That time is when
+        play returns plus one mixer buffer.
+        """
+        self.sound.play()
+        latency = MIXER_BUFFER / float(self.frequency)
+        self.start_time = events.now() + latency
+        return self.start_time
+
+    def onsets(self):
+        """
+        Returns the estimated onset of each file in the last playback, or
+        None if the list has not been played.
+        """
+        if self.start_time is None:
+            return None
+        return [self.start_time + o / float(self.frequency) for o in
+                self.offsets]
 
 
 def stop():
@@ -2,22 +2,20 @@
 Executing individual tests and batches of tests.
 """
 
+import charlie.tools.lazy as lazy  # first, so that start-up is timed
+import ast
 import importlib
-import os
 import sys
-import numpy as np
-import pandas
-try:
-    from PySide import QtGui, QtCore
-except ImportError:
-    from PyQt4 import QtGui, QtCore
+import traceback
 import charlie.tools.arguments as arguments
 import charlie.tools.data as data
 import charlie.tools.instructions as instructions
-import charlie.tools.questionnaires as questionnaires
-import charlie.tools.misc as misc
 import charlie.tools.visual as visual
-import charlie.tools.backup as backup
+np = lazy.lazy_import('numpy')
+pandas = lazy.lazy_import('pandas')
+QtGui = lazy.lazy_import('PySide.QtGui', 'PyQt4.QtGui')
+questionnaires = lazy.lazy_import('charlie.tools.questionnaires')
+backup = lazy.lazy_import('charlie.tools.backup')
 
 
 class Test:
@@ -25,13 +23,17 @@ class Test:
     """
     Test class. Initialised using the test_name, which must be a string with
     exactly the same name as a test in the test battery. Optionally supply a
-    batch_mode bool.
+    batch_mode bool, and the Session running the batch, whose display is then
+    used instead of a new one.
     """
 
-    def __init__(self, test_name, batch_mode=False, parent=None):
+    def __init__(self, test_name, batch_mode=False, parent=None,
+                 session=None):
 
         print '---Test object initialised.'
         self.batch_mode = batch_mode
+        self.session = session
+        self.preloader = None
         args = arguments.get_args()
         self.test_name = test_name
         self.proband_id = args.proband_id
@@ -77,7 +79,6 @@ class Test:
     def run_pygame(self):
 
         print '---This is a pygame test.'
-        self.screen = visual.Screen()
         self.trial_method = getattr(self.mod, 'trial_method')
 
         if hasattr(self.mod, 'black_bg'):
@@ -87,18 +88,27 @@ class Test:
             visual.BG_COLOUR = visual.LIGHT_GREY
             visual.DEFAULT_TEXT_COLOUR = visual.BLACK
 
-        img_path = data.pj(data.VISUAL_PATH, self.test_name)
-        if os.path.exists(img_path):
-            print '---Preloading images.'
-            files = [data.pj(img_path, f) for f in os.listdir(img_path)]
-            [self.screen.load_image(f) for f in files if misc.is_imgfile(f)]
+        if self.session:
+            self.screen = self.session.get_screen()
+        else:
+            self.screen = visual.Screen()
+
+        print '---Preloading images in the background.'
+        self.preloader = self.screen.preload_stimuli(
+            self.test_name, self.data_obj.control, preloader=self.preloader
+        )
 
         while self.data_obj.control:
 
             print '---New trial.'
             trial = self.data_obj.control.pop(0)
+            self.preloader.advance()
             trial_info = self.trial_method(self.screen, self.instr, trial)
             print trial_info
+            self.screen.end_frames(False)
+            timing = self.screen.frame_report()
+            if timing:
+                self.data_obj.to_log('frame timing: %s' % timing)
 
             if trial_info != 'EXIT':
 
@@ -157,24 +167,46 @@ class Test:
                         print '---Computing summary stats.'
                         summary_method = getattr(self.mod, 'summary_method')
                         self.data_obj.to_localdb(summary_method, self.instr)
+                    data.flush()
+                    if self.session:
+                        self.session.prepare_next()
 
             else:
 
                 print '---Exit detected.'
+                self.preloader.stop()
+                data.flush()
                 if self.batch_mode is False:
                     self.screen.kill()
                     break  # act as if the session is over
 
                 else:
-                    self.screen.kill()
+                    if self.session:
+                        self.session.close_screen()  # to show the prompt
+                    else:
+                        self.screen.kill()
                     return self.data_obj
 
-        self.screen.kill()
+        self.preloader.stop()
+        data.flush()
+        if not self.session:
+            self.screen.kill()
+
+    def start_preloading(self):
+        """
+        Starts decoding the test's images in the background before the test
+        is run. Needs a display.
+        """
+        print '---Preloading images for %s in the background.' % self.test_name
+        self.preloader = visual.preload(self.test_name, self.data_obj.control)
 
     def run_qt(self, from_gui):
 
         if self.data_obj.test_done is False:
 
+            if self.session:
+                self.session.close_screen()
+
             if from_gui is False:
 
                 screen = visual.Screen()
@@ -186,6 +218,7 @@ class Test:
                 app.aboutToQuit.connect(app.deleteLater)
                 window = MainWindow(self.data_obj, self.instr)
                 app.exec_()
+                data.flush()
 
             else:
 
@@ -194,6 +227,84 @@ class Test:
                 self.window.raise_()
 
 
+class Session:
+
+    """
+    Runs a batch of tests in one long-lived display. Creating a Screen
+    (pygame.init, set_mode, fonts, mixer) for every test and killing it at
+    the end made the screen flash and cost seconds between tests. Instead,
+    the first pygame test creates the screen, and every later one gets it
+    back after a reset. The database connection is already kept for the life
+    of the process (see data.connect). Once a test is over and its data and
+    summary stats are saved, the Test for the next one is created and starts
+    preloading its stimuli while the current one winds down. Qt tests need
+    the display closed, so it is reopened by the next pygame test.
+    """
+
+    def __init__(self, test_names):
+        self.test_names = list(test_names)  # tests still to run
+        self.screen = None
+        self.prepared = {}  # test name : Test, created ahead of time
+
+    def next_test(self):
+        """
+        Removes the next test name from the queue and returns its Test,
+        reusing the one created by prepare_next if there is one.
+        """
+        test_name = self.test_names.pop(0)
+        test = self.prepared.pop(test_name, None)
+        if test is None:
+            test = Test(test_name, True, session=self)
+        return test
+
+    def prepare_next(self):
+        """
+        Creates the Test for the next test name in the queue and, if the
+        display is open and it is a pygame test, starts preloading its images.
+        This is only an optimisation, so errors are printed rather than
+        raised; next_test then creates the Test again when it is due.
+        """
+        if not self.test_names or self.test_names[0] in self.prepared:
+            return
+        try:
+            test = Test(self.test_names[0], True, session=self)
+            if self.screen is not None and not test.user_controlled:
+                test.start_preloading()
+        except Exception:
+            print '---Could not prepare %s:\n%s' % (self.test_names[0],
+                                                    traceback.format_exc())
+            return
+        self.prepared[test.test_name] = test
+
+    def get_screen(self):
+        """
+        Returns the session's screen, reset for a new test, creating it if
+        necessary.
+        """
+        if self.screen is None:
+            self.screen = visual.Screen()
+        self.screen.reset()
+        return self.screen
+
+    def close_screen(self):
+        """
+        Closes the display. The next pygame test opens a new one.
+        """
+        if self.screen is not None:
+            self.screen.kill()
+            self.screen = None
+
+    def close(self):
+        """
+        Stops any preloading and closes the display.
+        """
+        for test in self.prepared.values():
+            if test.preloader:
+                test.preloader.stop()
+        self.prepared = {}
+        self.close_screen()
+
+
 def run_batch():
     """
     Run a sequence of tests.
@@ -230,31 +341,37 @@ def run_batch():
 
     test_names = [quickfix(l) for l in f]
     print '---Running the following tests in a batch:', test_names
+    session = Session(test_names)
+
+    try:
 
-    while test_names:
+        while session.test_names:
 
-        test_name = test_names.pop(0)
-        test = Test(test_name, True)
-        _data_obj = test.run()
-        print _data_obj
+            test = session.next_test()
+            test_name = test.test_name
+            _data_obj = test.run()
+            print _data_obj
 
-        if _data_obj is not None:
+            if _data_obj is not None:
 
-            choice = prompt()
+                choice = prompt()
 
-            if choice == 'quit':
+                if choice == 'quit':
 
-                sys.exit()
+                    sys.exit()
 
-            elif choice == 'restart':
+                elif choice == 'restart':
 
-                data.delete_data(_data_obj)
-                test_names = [test_name] + test_names
+                    data.delete_data(_data_obj)
+                    session.test_names.insert(0, test_name)
 
-            elif choice == 'resume':
+                elif choice == 'resume':
 
-                test_names = [test_name] + test_names
+                    session.test_names.insert(0, test_name)
 
+    finally:
+
+        session.close()
 
 
 def prompt():
@@ -318,6 +435,18 @@ def tests_in_batch(b):
     return blist
 
 
+def is_pygame_test(test_name):
+    """
+    Returns True if the test defines a trial_method, i.e., is run with pygame
+    rather than from a Qt GUI. The test's source is parsed rather than
+    imported, so this works without Qt installed.
+    """
+    f = data.pj(data.TESTS_PATH, test_name + '.py')
+    tree = ast.parse(open(f, 'rU').read(), f)
+    return any(isinstance(node, ast.FunctionDef) and
+               node.name == 'trial_method' for node in tree.body)
+
+
 def run_single_test(test_name):
     """
     Convenience function for running a single test.
@@ -329,8 +458,7 @@ def run_single_test(test_name):
 def main():
     args = arguments.get_parser().parse_args()
     quickfix = lambda f: f.replace('\n', '').replace('\r', '')
-    data.create_paths()
-    data.create_db()
+    data.bootstrap()
 
     if args.questionnaires:
         print '---Loading questionnaires to administer first:'
@@ -351,4 +479,6 @@ def main():
     elif args.test_name:
         test = Test(args.test_name)
         test.run()
-    backup.backup('sftp', 1)
\ No newline at end of file
+    backup.backup('sftp', 1)
+    if args.startup_report:
+        lazy.report()
\ No newline at end of file
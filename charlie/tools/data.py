@@ -6,17 +6,26 @@ Created on Thu Jan 15 09:13:47 2015
 @author: smathias
 """
 
+import atexit
+import csv
 import glob
+import json
 from datetime import datetime
 import cPickle
 import os
+import Queue
+import struct
+import time
+import traceback
+import zlib
 from os.path import dirname as pd
 from os.path import join as pj
 #from os import listdir as ld
 import sqlite3
+import threading
 import numpy as np
-import pandas
-import pandas.io.sql as sql
+import charlie.tools.lazy as lazy
+pandas = lazy.lazy_import('pandas')
 
 
 PACKAGE_DIR = os.path.abspath(pd(pd(__file__)))
@@ -38,6 +47,34 @@ TESTS_PATH = pj(PACKAGE_DIR, 'tests')
 BATCHES_PATH = pj(PACKAGE_DIR, 'batch_lists')
 QUESTIONNAIRE_TEMPLATES_PATH = pj(PACKAGE_DIR, 'questionnaire_templates')
 QUESTIONNAIRES_PATH = pj(PACKAGE_DIR, 'questionnaire_lists')
+JOURNAL_EXT = '.journal'
+JOURNAL_FSYNC_INTERVAL = 1  # records; every trial is on disk before the next
+JOURNAL_FRAME = struct.Struct('<II')
+SNAPSHOT_MAGIC = 'CDAT'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sIII')  # magic, version, length, crc32
+SNAPSHOT_SECTION = struct.Struct('<4sII')  # tag, length, crc32
+SNAPSHOT_FIELDS = ('proband_id', 'user_id', 'proj_id', 'test_name', 'lang',
+                   'test_started', 'test_done', 'date_started', 'date_done',
+                   'initialised', 'last_opened', 'last_updated')
+SNAPSHOT_COMPRESSION = 1  # zlib level; fast, as snapshots are saved mid-test
+COLUMN_TYPES = {'int': int, 'float': float, 'str': str, 'unicode': unicode,
+                'none': type(None)}
+WRITE_QUEUE_SIZE = 256  # jobs waiting for the persistence thread
+TMP_EXT = '.tmp'
+DAMAGED_EXT = '.damaged'
+STALE_TMP_AGE = 60  # seconds after which a temporary file must be orphaned
+STORE_DTYPES = {int: np.int64, float: np.float64}
+STORE_CAPACITY = 64
+SQL_TYPES = {int: 'INTEGER', float: 'REAL', str: 'TEXT'}
+SUMMARY_KEY = ('proband_id', 'test_name')
+DB_TIMEOUT = 30
+DB_CACHED_STATEMENTS = 256
+
+_bootstrapped = []
+_ready_tables = set()
+_connections = threading.local()
+_writer = {'queue': None, 'pid': None, 'errors': []}
 
 
 def ld(path):
@@ -62,6 +99,31 @@ def create_paths():
     [os.makedirs(p) for p in to_create if not os.path.exists(p)]
 
 
+def set_data_path(path):
+    """
+    Points DATA_PATH, and every path within it (including the local
+    database), at the given directory instead of the one in the package.
+    Used to keep synthetic data (e.g., from load tests) away from real data.
+    Queued writes are flushed to the old directory first, and this thread's
+    database connection is closed; connections in other threads are reopened
+    on the new database the next time they are used (see connect).
+    """
+    flush()
+    _close_connection()
+    global DATA_PATH, RAW_DATA_PATH, BACKUP_DATA_PATH, QUESTIONNAIRE_DATA_PATH
+    global INSPECTION_DATA_PATH, CSV_DATA_PATH, LOCAL_DB_F, DB_PATH
+    DATA_PATH = path
+    RAW_DATA_PATH = pj(DATA_PATH, 'raw')
+    BACKUP_DATA_PATH = pj(DATA_PATH, 'backups')
+    QUESTIONNAIRE_DATA_PATH = pj(DATA_PATH, 'questionnaire_data')
+    INSPECTION_DATA_PATH = pj(DATA_PATH, 'inspections')
+    CSV_DATA_PATH = pj(DATA_PATH, 'csv')
+    LOCAL_DB_F = pj(DATA_PATH, 'db', 'localdb.sqlite')
+    DB_PATH = pj(DATA_PATH, 'db')
+    del _bootstrapped[:]
+    _ready_tables.clear()
+
+
 def create_db():
     """
     Initialises the local database, if it does not already exist.
@@ -84,53 +146,157 @@ def create_db():
         con.close()
 
 
-def populate_demographics():
+def bootstrap():
     """
-    Populates the 'probands' table in the local database based on information
-    contained within the other tables. This is useful because running the test
-    battery from the command line will not update the probands table by itself.
-    Also returns the data frame.
+    Creates the directory structure, the local database and its index tables,
+    but only the first time it is called in each process.
     """
-    create_paths()
-    create_db()
-    print '---Populating the probands sql table'
-    con = sqlite3.connect(LOCAL_DB_F)
-    try:
-        df = pandas.read_sql('SELECT * from probands', con)
-    except:
-        cols = [
-            'proband_id', 'user_id', 'proj_id', 'sex', 'age', 'tests_compl'
-        ]
-        df = pandas.DataFrame(columns=cols)
-    df1 = pandas.read_sql(
-        "SELECT * FROM sqlite_master WHERE type='table'", con
+    if not _bootstrapped:
+        create_paths()
+        create_db()
+        con = sqlite3.connect(LOCAL_DB_F, timeout=DB_TIMEOUT)
+        con.execute('PRAGMA journal_mode=WAL')
+        with con:
+            create_index_tables(con)
+        con.close()
+        _bootstrapped.append(True)
+        recover_data()
+
+
+def connect():
+    """
+    Returns the connection to the local database belonging to the current
+    thread, opening it the first time. Connections are reused for the life of
+    the thread (sqlite3 caches prepared statements per connection), use
+    write-ahead logging so that readers never block the writer, and wait up
+    to DB_TIMEOUT seconds for a lock held by another process instead of
+    failing with 'database is locked'. Callers should not close it. A
+    connection to a database other than LOCAL_DB_F (see set_data_path) is
+    closed and replaced.
+    """
+    con = getattr(_connections, 'con', None)
+    if con is not None and _connections.f != LOCAL_DB_F:
+        _close_connection()
+        con = None
+    if con is None or _connections.pid != os.getpid():
+        bootstrap()
+        con = sqlite3.connect(LOCAL_DB_F, timeout=DB_TIMEOUT,
+                              cached_statements=DB_CACHED_STATEMENTS)
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        _connections.con = con
+        _connections.pid = os.getpid()
+        _connections.f = LOCAL_DB_F
+    return con
+
+
+def _close_connection():
+    """
+    Closes the current thread's connection to the local database, if it has
+    one that was opened in this process.
+    """
+    con = getattr(_connections, 'con', None)
+    if con is not None and _connections.pid == os.getpid():
+        con.close()
+    _connections.con = None
+
+
+def create_index_tables(con):
+    """
+    Creates the 'proband_tests' table, which has one row for each test each
+    proband has completed, along with indexes on proband_id in it and in the
+    'probands' table, if they do not already exist. When 'proband_tests' is
+    first created, it is filled from the summary tables already in the
+    database, so older databases are converted the first time they are used.
+    """
+    s = "SELECT name FROM sqlite_master WHERE type='table'"
+    tables = [r[0] for r in con.execute(s)]
+    if 'probands' not in tables:
+        cols = ['proband_id', 'user_id', 'proj_id', 'sex', 'age', 'tests_compl']
+        con.execute('CREATE TABLE probands (%s)' % ', '.join(
+            '%s TEXT' % c for c in cols))
+    con.execute(
+        'CREATE TABLE IF NOT EXISTS proband_tests (proband_id TEXT, '
+        'user_id TEXT, proj_id TEXT, test_name TEXT, '
+        'UNIQUE (proband_id, test_name))'
+    )
+    con.execute(
+        'CREATE INDEX IF NOT EXISTS proband_tests_proband_id ON '
+        'proband_tests (proband_id)'
+    )
+    con.execute(
+        'CREATE INDEX IF NOT EXISTS probands_proband_id ON probands '
+        '(proband_id)'
     )
-    tables = df1['name'].tolist()
-    if 'probands' in tables:
-        tables.remove('probands')
-    if 'notes' in tables:
-        tables.remove('notes')
-    tables = [t for t in tables if '_trials' not in t]
-    _probands = {}
-    for test_name in sorted(tables):
+    if 'proband_tests' in tables:
+        return
+    print '---Indexing the tests completed by each proband'
+    excl = ['probands', 'notes', 'proband_tests']
+    summary_tables = [t for t in tables if t not in excl and '_trials' not in t]
+    for test_name in sorted(summary_tables):
         try:
-            df2 = pandas.read_sql('SELECT * from %s' % test_name, con)
-            df2 = df2[['proband_id', 'user_id', 'proj_id']]
-            df = pandas.concat([df, df2])
-            _probands[test_name] = df2.proband_id.tolist()
-        except KeyError:
+            con.execute(
+                'INSERT OR IGNORE INTO proband_tests SELECT proband_id, '
+                'user_id, proj_id, ? FROM %s' % _quote(test_name), (test_name, )
+            )
+        except sqlite3.OperationalError:
             continue
-    df.drop_duplicates(subset=['proband_id'], inplace=True)
+    con.execute(
+        'INSERT INTO probands (proband_id, user_id, proj_id) SELECT '
+        'proband_id, user_id, proj_id FROM proband_tests AS t WHERE NOT '
+        'EXISTS (SELECT 1 FROM probands AS p WHERE p.proband_id = '
+        't.proband_id) GROUP BY proband_id'
+    )
+    update_tests_compl(con)
+
+
+def update_tests_compl(con, proband_id=None):
+    """
+    Sets the 'tests_compl' column of the 'probands' table from the
+    'proband_tests' table, either for one proband or for all of them.
+    """
+    s = 'SELECT proband_id, test_name FROM proband_tests'
+    if proband_id is None:
+        rows = con.execute(s + ' ORDER BY proband_id, test_name')
+    else:
+        rows = con.execute(s + ' WHERE proband_id = ? ORDER BY test_name',
+                           (proband_id, ))
+    tests_compl = {}
+    for p, test_name in rows:
+        tests_compl[p] = tests_compl.get(p, '') + '%s ' % test_name
+    con.executemany(
+        'UPDATE probands SET tests_compl = ? WHERE proband_id = ?',
+        [(v, k) for k, v in tests_compl.iteritems()]
+    )
+
+
+def record_proband_test(con, proband_id, user_id, proj_id, test_name):
+    """
+    Records that a proband has completed a test. The proband is added to the
+    'probands' table if necessary and their 'tests_compl' entry is updated.
+    This only touches the rows belonging to the proband.
+    """
+    con.execute(
+        'INSERT OR REPLACE INTO proband_tests VALUES (?, ?, ?, ?)',
+        (proband_id, user_id, proj_id, test_name)
+    )
+    s = 'SELECT 1 FROM probands WHERE proband_id = ?'
+    if con.execute(s, (proband_id, )).fetchone() is None:
+        con.execute(
+            'INSERT INTO probands (proband_id, user_id, proj_id) VALUES '
+            '(?, ?, ?)', (proband_id, user_id, proj_id)
+        )
+    update_tests_compl(con, proband_id)
+
+
+def populate_demographics():
+    """
+    Returns the contents of the 'probands' table in the local database as a
+    data frame indexed by proband_id. The table is kept up to date as tests
+    are completed (see record_proband_test), so this is just a query.
+    """
+    df = pandas.read_sql('SELECT * from probands', connect())
     df.set_index('proband_id', drop=False, inplace=True)
-    for i, row in df.iterrows():
-        x = ''
-        for test_name in _probands:
-            if row.proband_id in _probands[test_name]:
-                x += '%s ' % test_name
-        df.ix[i, 'tests_compl'] = x
-    df.replace('', np.nan, inplace=True)
-    df.to_sql('probands', con, index=False, if_exists='replace')
-    con.close()
     return df
 
 
@@ -140,21 +306,647 @@ def replace_demographics(df):
     the contents of the data frame.
     """
     print '---Replacing contents of probands sql table'
-    con = sqlite3.connect(LOCAL_DB_F)
+    con = connect()
     df.replace('', np.nan, inplace=True)
     df.to_sql('probands', con, index=False, if_exists='replace')
-    con.close()
+    with con:
+        create_index_tables(con)
+
+
+def _quote(name):
+    """
+    Quotes a table or column name for use in an sqlite statement.
+    """
+    return '"%s"' % str(name).replace('"', '""')
+
+
+def _sql_value(v):
+    """
+    Converts numpy scalars to the equivalent python objects and missing
+    values to None so that sqlite3 can store them.
+    """
+    if hasattr(v, 'item'):
+        v = v.item()
+    if isinstance(v, float) and v != v:
+        v = None
+    return v
+
+
+def _sql_type(v):
+    """
+    Returns the sqlite column type for an example value.
+    """
+    v = _sql_value(v)
+    if isinstance(v, (bool, int, long)):
+        return 'INTEGER'
+    if isinstance(v, float):
+        return 'REAL'
+    return 'TEXT'
+
+
+def create_table(con, table_name, columns, key):
+    """
+    Makes sure table_name exists in the database and has all of the columns,
+    a list of (name, sqlite type) tuples. Missing columns are added to an
+    existing table. A unique index is created on the columns named in key so
+    that rows can be upserted; any duplicates already in a table created
+    before the index existed are removed first, keeping the newest, as an
+    upsert would. Both happen in one transaction (see _add_unique_index).
+    Each table is only checked once per process.
+    """
+    ready = (table_name, tuple(columns), tuple(key))
+    if ready in _ready_tables:
+        return
+    t = _quote(table_name)
+    existing = [r[1] for r in con.execute('PRAGMA table_info(%s)' % t)]
+    if not existing:
+        cols = ', '.join('%s %s' % (_quote(n), c) for n, c in columns)
+        con.execute('CREATE TABLE %s (%s)' % (t, cols))
+    else:
+        for name, sql_type in columns:
+            if name not in existing:
+                con.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    t, _quote(name), sql_type))
+    index_name = table_name + '_key'
+    s = "SELECT 1 FROM sqlite_master WHERE type='index' AND name=?"
+    if key and con.execute(s, (index_name, )).fetchone() is None:
+        _add_unique_index(con, table_name, index_name, key)
+    _ready_tables.add(ready)
+
+
+def _add_unique_index(con, table_name, index_name, key):
+    """
+    Deletes all but the newest of any rows in table_name that share the
+    columns in key, then creates a unique index on them. sqlite3 commits
+    before each CREATE statement, which would leave a table de-duplicated but
+    without its index if the index could not be created, so both statements
+    run in one explicit transaction instead (committing anything pending
+    first).
+    """
+    t = _quote(table_name)
+    key_cols = ', '.join(_quote(k) for k in key)
+    isolation_level = con.isolation_level
+    con.commit()
+    con.isolation_level = None
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            con.execute(
+                'DELETE FROM %s WHERE rowid NOT IN (SELECT MAX(rowid) FROM %s '
+                'GROUP BY %s)' % (t, t, key_cols)
+            )
+            con.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                _quote(index_name), t, key_cols))
+        except:
+            con.execute('ROLLBACK')
+            raise
+        con.execute('COMMIT')
+    finally:
+        con.isolation_level = isolation_level
+
+
+def create_trials_table(con, table_name, columns):
+    """
+    Makes sure a trials table exists and has all of the columns (see
+    create_table). Trials have no key that is unique in every test, and a
+    unique index on all of the columns would treat rows containing NULLs as
+    distinct, so each proband's trials are replaced as a whole instead (see
+    replace_proband_rows), which an index on proband_id keeps quick. The
+    unique index that older versions put on every column is dropped.
+    """
+    create_table(con, table_name, columns, [])
+    ready = (table_name, 'trials')
+    if ready in _ready_tables:
+        return
+    t = _quote(table_name)
+    con.execute('DROP INDEX IF EXISTS %s' % _quote(table_name + '_key'))
+    con.execute('CREATE INDEX IF NOT EXISTS %s ON %s (proband_id)' % (
+        _quote(table_name + '_proband_id'), t))
+    _ready_tables.add(ready)
+
+
+def replace_proband_rows(con, table_name, names, rows, proband_id):
+    """
+    Deletes every row of table_name belonging to proband_id and inserts rows
+    (an iterable of tuples in the order given by names) instead.
+    """
+    con.execute('DELETE FROM %s WHERE proband_id = ?' % _quote(table_name),
+                (proband_id, ))
+    s = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        _quote(table_name), ', '.join(_quote(n) for n in names),
+        ', '.join('?' * len(names))
+    )
+    con.executemany(s, ([_sql_value(v) for v in row] for row in rows))
+
+
+def upsert_rows(con, table_name, names, rows):
+    """
+    Inserts rows (an iterable of tuples in the order given by names) into
+    table_name, replacing any existing rows with the same key.
+    """
+    s = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+        _quote(table_name), ', '.join(_quote(n) for n in names),
+        ', '.join('?' * len(names))
+    )
+    con.executemany(s, ([_sql_value(v) for v in row] for row in rows))
+
+
+def df_rows(df):
+    """
+    Returns the column names of a pandas DataFrame, their sqlite types (taken
+    from the first row) and the rows as a list of tuples.
+    """
+    names = [str(c) for c in df.columns]
+    rows = [tuple(r) for r in df.itertuples(index=False)]
+    if rows:
+        columns = [(n, _sql_type(v)) for n, v in zip(names, rows[0])]
+    else:
+        columns = [(n, 'TEXT') for n in names]
+    return names, columns, rows
+
+
+def upsert_df(con, table_name, df, key=SUMMARY_KEY):
+    """
+    Upserts the rows of a pandas DataFrame, such as a table of summary
+    statistics, into table_name. Only the columns in key that are present in
+    df form the unique key.
+    """
+    names, columns, rows = df_rows(df)
+    create_table(con, table_name, columns, [k for k in key if k in names])
+    upsert_rows(con, table_name, names, rows)
+
+
+def _run_writer(q):
+    """
+    Body of the persistence thread. Runs the jobs in the queue one at a time,
+    in the order they were submitted. A failed job is printed and kept for
+    flush to raise; the jobs after it still run.
+    """
+    while True:
+        f, args = q.get()
+        try:
+            f(*args)
+        except Exception:
+            _writer['errors'].append(traceback.format_exc())
+            print '---Error writing data:\n%s' % _writer['errors'][-1]
+        finally:
+            q.task_done()
+
+
+def write_behind(f, *args):
+    """
+    Runs f(*args) on the persistence thread, after every job submitted before
+    it, so that a trial can be written while the next one is presented. Only
+    blocks if WRITE_QUEUE_SIZE jobs are already waiting. The thread is started
+    the first time this is called in each process. Anything f needs must be
+    in args and must not change afterwards; pass bytes, not a Data instance
+    that the test is still adding to.
+    """
+    q = _writer['queue']
+    if q is None or _writer['pid'] != os.getpid():
+        q = _writer['queue'] = Queue.Queue(WRITE_QUEUE_SIZE)
+        _writer['pid'] = os.getpid()
+        t = threading.Thread(target=_run_writer, args=(q, ),
+                             name='persistence')
+        t.daemon = True
+        t.start()
+    q.put((f, args))
+
+
+def flush():
+    """
+    Waits until the persistence thread has written everything submitted so
+    far. Raises IOError if any of it failed. Called before data files are read
+    or deleted, at the end of each test, and when the interpreter exits.
+    """
+    if _writer['queue'] is not None and _writer['pid'] == os.getpid():
+        _writer['queue'].join()
+    if _writer['errors']:
+        errors = _writer['errors']
+        _writer['errors'] = []
+        raise IOError('%i data writes failed; the first was:\n%s' % (
+            len(errors), errors[0]))
+
+
+atexit.register(flush)
+
+
+def _rename(src, dst):
+    """
+    Renames src to dst, replacing dst. This is atomic on POSIX systems. On
+    Windows, os.rename cannot replace a file, so dst is removed first.
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def _fsync_dir(path):
+    """
+    Fsyncs the directory at path, so that files created or renamed in it
+    survive a power cut. Directories cannot be opened on Windows, where this
+    does nothing.
+    """
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_file(f, payload, sync=False):
+    """
+    Replaces the contents of f with payload. The bytes go to a temporary file
+    first, which is then renamed to f, so that a crash leaves the old file or
+    the new one but never half of the new one. If sync is True, the new file
+    and the rename are fsynced as well, which also covers power cuts.
+    """
+    tmp = f + TMP_EXT
+    with open(tmp, 'wb') as fh:
+        fh.write(payload)
+        if sync:
+            fh.flush()
+            os.fsync(fh.fileno())
+    _rename(tmp, f)
+    if sync:
+        _fsync_dir(pd(f))
+
+
+def _append_file(f, payload, sync=False):
+    """
+    Appends payload to f, fsyncing it if sync is True (and its directory too,
+    if f is new).
+    """
+    new = not os.path.exists(f)
+    with open(f, 'ab') as fh:
+        fh.write(payload)
+        fh.flush()
+        if sync:
+            os.fsync(fh.fileno())
+    if sync and new:
+        _fsync_dir(pd(f))
+
+
+def _write_snapshot(f, payload, journal):
+    """
+    Replaces the snapshot at f with payload and then deletes its journal,
+    whose records are all in the new snapshot.
+    """
+    replace_file(f, payload, True)
+    if os.path.exists(journal):
+        os.remove(journal)
+
+
+def _json_value(v):
+    """
+    Returns v if it can go in a JSON header as it is, or else str(v) (e.g.,
+    for datetimes). Byte strings that are not UTF-8 are read as Latin-1.
+    """
+    if isinstance(v, str):
+        try:
+            return v.decode('utf-8')
+        except UnicodeDecodeError:
+            return v.decode('latin-1')
+    if v is None or isinstance(v, (bool, int, long, float, unicode)):
+        return v
+    return str(v)
+
+
+def _column_kind(values):
+    """
+    Returns the name of the encoding used for a column of values: the one
+    type they all share (exactly, so that bools are not ints) if it is in
+    COLUMN_TYPES, or 'pickle'.
+    """
+    types = set(type(v) for v in values)
+    if len(types) == 1:
+        t = types.pop()
+        for kind, ktype in COLUMN_TYPES.iteritems():
+            if t is ktype:
+                return kind
+    return 'pickle'
+
+
+def _pack_column(kind, values):
+    """
+    Returns the bytes of a column of values of the given kind. Numbers are
+    little-endian arrays; strings are an array of their lengths in bytes
+    followed by the strings themselves.
+    """
+    if kind == 'int':
+        return np.array(values, '<i8').tostring()
+    if kind == 'float':
+        return np.array(values, '<f8').tostring()
+    if kind in ('str', 'unicode'):
+        if kind == 'unicode':
+            values = [v.encode('utf-8') for v in values]
+        return np.array([len(v) for v in values], '<i4').tostring() + \
+            ''.join(values)
+    if kind == 'none':
+        return ''
+    return cPickle.dumps(list(values), cPickle.HIGHEST_PROTOCOL)
+
+
+def _unpack_column(kind, s, n):
+    """
+    Returns the list of n values in the bytes s of a column of the given kind.
+    """
+    if kind == 'int':
+        return np.fromstring(s, '<i8').tolist()
+    if kind == 'float':
+        return np.fromstring(s, '<f8').tolist()
+    if kind in ('str', 'unicode'):
+        lengths = np.fromstring(s[:4 * n], '<i4')
+        ends = (np.cumsum(lengths) + 4 * n).tolist()
+        values = [s[i - k:i] for i, k in zip(ends, lengths.tolist())]
+        if kind == 'unicode':
+            values = [v.decode('utf-8') for v in values]
+        return values
+    if kind == 'none':
+        return [None] * n
+    return cPickle.loads(s)
+
+
+def _pack_rows(rows):
+    """
+    Returns the bytes of a list of rows (trials or log entries) stored column
+    by column: a JSON directory of the columns, then each column (see
+    _pack_column). Rows that are not all tuples of the same length are
+    pickled whole instead.
+    """
+    if rows is None:
+        directory = {'rows': None}
+        columns = []
+    elif all(type(row) is tuple for row in rows) and \
+            len(set(len(row) for row in rows)) <= 1:
+        columns = zip(*rows)
+        kinds = [_column_kind(col) for col in columns]
+        columns = [_pack_column(k, col) for k, col in zip(kinds, columns)]
+        directory = {'rows': 'tuple', 'n': len(rows),
+                     'columns': [[k, len(s)] for k, s in zip(kinds, columns)]}
+    else:
+        columns = [cPickle.dumps(rows, cPickle.HIGHEST_PROTOCOL)]
+        directory = {'rows': 'pickle', 'columns': [['pickle', len(columns[0])]]}
+    directory = json.dumps(directory)
+    return struct.pack('<I', len(directory)) + directory + ''.join(columns)
+
+
+def _unpack_rows(s):
+    """
+    Returns the list of rows in the bytes s made by _pack_rows.
+    """
+    n = struct.unpack('<I', s[:4])[0]
+    directory = json.loads(s[4:4 + n])
+    offset = 4 + n
+    columns = []
+    for kind, size in directory.get('columns', []):
+        columns.append((kind, s[offset:offset + size]))
+        offset += size
+    if directory['rows'] is None:
+        return None
+    if directory['rows'] == 'pickle':
+        return cPickle.loads(columns[0][1])
+    n = directory['n']
+    return zip(*[_unpack_column(kind, c, n) for kind, c in columns]) if \
+        columns else [()] * n
+
+
+def snapshot_header(data_obj):
+    """
+    Returns the header of a snapshot of the data instance: a dict of the
+    SNAPSHOT_FIELDS, as JSON values, and the number of trials, log entries
+    and trials still to run.
+    """
+    d = data_obj.__dict__
+    header = dict((k, _json_value(d.get(k))) for k in SNAPSHOT_FIELDS)
+    header['generation'] = d.get('_journal_generation')
+    header['n_trials'] = len(d.get('data') or [])
+    header['n_log'] = len(d.get('log') or [])
+    header['n_control'] = len(d.get('control') or [])
+    return header
+
+
+def pack_snapshot(data_obj):
+    """
+    Returns the bytes of a snapshot of the data instance. The file starts with
+    a SNAPSHOT_HEADER giving the format version and the length and checksum
+    of a small JSON header (see snapshot_header), so that the header can be
+    read without the rest of the file. Then come three sections, each a
+    SNAPSHOT_SECTION (tag, length, checksum) followed by zlib-compressed
+    bytes: the trials column by column ('TRLS'), the log ('LOGS'), and the
+    rest of the instance's attributes, pickled ('STAT').
+    """
+    state = data_obj.__getstate__()
+    header = json.dumps(snapshot_header(data_obj), sort_keys=True)
+    sections = [
+        ('TRLS', _pack_rows(state.pop('data', None))),
+        ('LOGS', _pack_rows(state.pop('log', None))),
+        ('STAT', cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)),
+    ]
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header),
+                                  zlib.crc32(header) & 0xffffffff), header]
+    for tag, payload in sections:
+        payload = zlib.compress(payload, SNAPSHOT_COMPRESSION)
+        parts.append(SNAPSHOT_SECTION.pack(tag, len(payload),
+                                           zlib.crc32(payload) & 0xffffffff))
+        parts.append(payload)
+    return ''.join(parts)
+
+
+def _check(f, s, n, crc, what):
+    """
+    Raises ValueError if the bytes s are not n long or fail their checksum.
+    """
+    if len(s) != n or zlib.crc32(s) & 0xffffffff != crc:
+        raise ValueError('%s is damaged: bad %s' % (f, what))
+
+
+def _read_prefix(fh, f):
+    """
+    Reads the SNAPSHOT_HEADER from the open file fh. Returns the version and
+    the length and checksum that follow it, or None if the file is a plain
+    pickle from before snapshots had a header.
+    """
+    s = fh.read(SNAPSHOT_HEADER.size)
+    if not s.startswith(SNAPSHOT_MAGIC):
+        return None
+    if len(s) < SNAPSHOT_HEADER.size:
+        raise ValueError('%s is damaged: truncated header' % f)
+    _, version, n, crc = SNAPSHOT_HEADER.unpack(s)
+    if version > SNAPSHOT_VERSION:
+        raise ValueError('%s is a version %i snapshot; this version of charlie '
+                         'reads up to version %i' % (f, version,
+                                                     SNAPSHOT_VERSION))
+    return version, n, crc
+
+
+def read_header(f):
+    """
+    Returns the header of the snapshot at path f (see snapshot_header). Only
+    the header is read, so this is quick enough for scanning every file in a
+    directory. Older snapshots have no separate header and are read in full.
+    Raises ValueError if the header is damaged.
+    """
+    with open(f, 'rb') as fh:
+        prefix = _read_prefix(fh, f)
+        if prefix is not None and prefix[0] >= 2:
+            _, n, crc = prefix
+            s = fh.read(n)
+            _check(f, s, n, crc, 'header')
+            return json.loads(s)
+    return snapshot_header(read_snapshot(f))
+
+
+def snapshot_version(f):
+    """
+    Returns the format version of the snapshot at path f: 0 for a plain
+    pickle, 1 for a checksummed pickle, or SNAPSHOT_VERSION.
+    """
+    with open(f, 'rb') as fh:
+        prefix = _read_prefix(fh, f)
+    return 0 if prefix is None else prefix[0]
+
+
+def read_snapshot(f):
+    """
+    Returns the data instance in the snapshot at path f (see pack_snapshot).
+    Raises ValueError if the file is truncated or fails a checksum. Older
+    formats are still read: plain pickles, from before snapshots had a
+    header, and version 1 snapshots, which are a checksummed pickle.
+    """
+    with open(f, 'rb') as fh:
+        prefix = _read_prefix(fh, f)
+        if prefix is None:
+            fh.seek(0)
+            try:
+                return cPickle.load(fh)
+            except Exception:
+                raise ValueError('%s is not a snapshot or is damaged' % f)
+        version, n, crc = prefix
+        s = fh.read(n)
+        _check(f, s, n, crc, 'header' if version >= 2 else 'pickle')
+        if version == 1:
+            return cPickle.loads(s)
+        header = json.loads(s)
+        sections = {}
+        for _ in range(3):
+            s = fh.read(SNAPSHOT_SECTION.size)
+            if len(s) < SNAPSHOT_SECTION.size:
+                raise ValueError('%s is damaged: truncated' % f)
+            tag, n, crc = SNAPSHOT_SECTION.unpack(s)
+            s = fh.read(n)
+            _check(f, s, n, crc, tag + ' section')
+            sections[tag] = zlib.decompress(s)
+    state = cPickle.loads(sections['STAT'])
+    state['data'] = _unpack_rows(sections['TRLS'])
+    state['log'] = _unpack_rows(sections['LOGS'])
+    data_obj = Data(header['proband_id'], header['lang'], header['user_id'],
+                    header['proj_id'], header['test_name'],
+                    state['output_format'])
+    data_obj.__dict__ = state
+    return data_obj
+
+
+def _set_aside(f):
+    """
+    Renames a damaged file to f + DAMAGED_EXT, so that it is kept for
+    inspection but no longer read.
+    """
+    _rename(f, f + DAMAGED_EXT)
+    print '---Damaged file %s moved to %s.' % (f, f + DAMAGED_EXT)
+
+
+def recover_snapshot(f):
+    """
+    Returns the newest intact snapshot of the data instance at path f, or None
+    if there is none, after tidying up what a crash may have left behind. A
+    complete snapshot in f + TMP_EXT that never got renamed over f is newer
+    than f, so it replaces f and its journal (whose records it contains); a
+    partial one is deleted. A damaged f is set aside with its journal.
+    """
+    tmp = f + TMP_EXT
+    if os.path.exists(tmp):
+        try:
+            newer = read_snapshot(tmp)
+        except ValueError:
+            newer = None
+        try:
+            older = read_snapshot(f) if os.path.exists(f) else None
+        except ValueError:
+            older = None
+        generation = lambda d: getattr(d, '_journal_generation', '')
+        if newer is not None and (older is None or
+                                  generation(newer) > generation(older)):
+            _rename(tmp, f)
+            journal = os.path.splitext(f)[0] + JOURNAL_EXT
+            if os.path.exists(journal):
+                os.remove(journal)
+            print '---Recovered the snapshot being saved in %s.' % f
+            return newer
+        os.remove(tmp)
+    if not os.path.exists(f):
+        return None
+    try:
+        return read_snapshot(f)
+    except ValueError as e:
+        print '---%s' % e
+        _set_aside(f)
+        journal = os.path.splitext(f)[0] + JOURNAL_EXT
+        if os.path.exists(journal):
+            _set_aside(journal)
+        return None
+
+
+def recover_data():
+    """
+    Recovers from a crash during a save, by running recover_snapshot on every
+    snapshot whose temporary file was left in RAW_DATA_PATH, and deleting
+    temporary csv files (the csv is rewritten in full when the test resumes).
+    Only temporary files older than STALE_TMP_AGE are touched, as newer ones
+    may belong to another process that is still running. Called by
+    bootstrap, so it runs once at start-up; it only lists two directories,
+    so it takes no time unless there is something to recover.
+    """
+    now = time.time()
+    stale = lambda f: now - os.path.getmtime(f) > STALE_TMP_AGE
+    for tmp in glob.glob(pj(RAW_DATA_PATH, '*' + TMP_EXT)):
+        if stale(tmp):
+            recover_snapshot(tmp[:-len(TMP_EXT)])
+    for tmp in glob.glob(pj(CSV_DATA_PATH, '*' + TMP_EXT)):
+        if stale(tmp):
+            os.remove(tmp)
+
+
+def _write_csv(f, rows, header=None):
+    """
+    Appends rows (lists of encoded cells) to the csv file f or, if a header is
+    given, replaces f with the header followed by the rows.
+    """
+    if header is None:
+        with open(f, 'ab') as fh:
+            csv.writer(fh, lineterminator='\n').writerows(rows)
+    else:
+        tmp = f + TMP_EXT
+        with open(tmp, 'wb') as fh:
+            writer = csv.writer(fh, lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows(rows)
+        _rename(tmp, f)
 
 
 def load_data(proband_id, lang, user_id, proj_id, test_name, output_format,
               create_if_not_found=True):
     """
-    Returns the pickled instance of a data class corresponding to the specific
-    proband and test, if it exists. By default, a new instance is returned if
-    an existing one is not found.
+    Returns the saved instance of a data class corresponding to the specific
+    proband and test, if it exists. Any trials recorded in the journal since
+    the instance was last pickled are replayed onto it. If a crash interrupted
+    a save, the newest intact snapshot is used (see recover_snapshot). By
+    default, a new instance is returned if an existing one is not found.
     """
-    create_paths()
-    create_db()
+    bootstrap()
+    flush()
 
     data_obj = Data(proband_id,
                     lang,
@@ -163,9 +955,11 @@ def load_data(proband_id, lang, user_id, proj_id, test_name, output_format,
                     test_name,
                     output_format)
 
-    if os.path.exists(data_obj.abs_filename):
+    old_data_obj = recover_snapshot(data_obj.abs_filename)
+    if old_data_obj is not None:
 
-        old_data_obj = cPickle.load(open(data_obj.abs_filename, 'rb'))
+        replay_journal(old_data_obj)
+        old_data_obj._csv_path = None
         old_data_obj.last_opened = (str(datetime.now()))
         return old_data_obj
 
@@ -177,15 +971,143 @@ def load_data(proband_id, lang, user_id, proj_id, test_name, output_format,
 
 def save_data(data_obj):
     """
-    Saves the raw data to the path specified within the data instance. If
+    Saves the raw data to the path specified within the data instance. This is
+    a full snapshot of the instance, so the journal is started afresh. The
+    instance is packed straight away (see pack_snapshot), but the file is
+    written by the persistence thread (see write_behind), crash-safely: to a
+    temporary file that is fsynced and then renamed over the old snapshot. If
     data_obj.proband_id is 'TEST', this function does nothing.
     """
-    create_paths()
-    create_db()
+    bootstrap()
     if not os.path.exists(data_obj.directory):
         os.makedirs(data_obj.directory)
     if data_obj.proband_id != 'TEST':
-        cPickle.dump(data_obj, open(data_obj.abs_filename, 'wb'))
+        data_obj._journal_generation = str(datetime.now())
+        data_obj._journal_base = data_obj.abs_filename
+        data_obj._journal_control = data_obj.control
+        data_obj._journal_nrows = len(data_obj.data or [])
+        data_obj._journal_nlog = len(data_obj.log)
+        data_obj._journal_nrecords = 0
+        write_behind(_write_snapshot, data_obj.abs_filename,
+                     pack_snapshot(data_obj), journal_filename(data_obj))
+
+
+def journal_filename(data_obj):
+    """
+    Returns the path of the journal belonging to the data instance.
+    """
+    return os.path.splitext(data_obj.abs_filename)[0] + JOURNAL_EXT
+
+
+def append_journal(data_obj):
+    """
+    Appends one framed record to the journal containing only what has changed
+    since the previous record: new trials, new log entries, the remaining
+    control iterable and the small attributes of the instance. The cost of
+    this does not depend on how many trials have already been recorded. The
+    record is written by the persistence thread, and the journal is fsynced
+    every JOURNAL_FSYNC_INTERVAL records and whenever the test is done.
+    """
+    if data_obj.proband_id == 'TEST':
+        return
+    if getattr(data_obj, '_journal_base', None) != data_obj.abs_filename:
+        save_data(data_obj)
+        return
+
+    rows = data_obj.data or []
+    record = {'generation': data_obj._journal_generation}
+    if len(rows) >= data_obj._journal_nrows:
+        record['data'] = rows[data_obj._journal_nrows:]
+    else:
+        record['all_data'] = list(rows)
+    record['log'] = data_obj.log[data_obj._journal_nlog:]
+    if data_obj.control is data_obj._journal_control and \
+            data_obj.control is not None:
+        record['control_len'] = len(data_obj.control)
+    else:
+        record['control'] = data_obj.control
+    record['state'] = dict(
+        (k, v) for k, v in data_obj.__dict__.iteritems()
+        if k not in ('data', 'control', 'log') and not k.startswith('_')
+    )
+
+    payload = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+    frame = JOURNAL_FRAME.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+    data_obj._journal_nrecords += 1
+    sync = data_obj.test_done or \
+        data_obj._journal_nrecords % JOURNAL_FSYNC_INTERVAL == 0
+    write_behind(_append_file, journal_filename(data_obj), frame + payload,
+                 sync)
+
+    data_obj._journal_control = data_obj.control
+    data_obj._journal_nrows = len(rows)
+    data_obj._journal_nlog = len(data_obj.log)
+
+
+def read_journal(f):
+    """
+    Returns the list of intact records in the journal at path f and the offset
+    of the end of the last intact record. Reading stops at the first frame
+    that is truncated or fails its checksum, which is what a crash in the
+    middle of a write leaves behind.
+    """
+    records = []
+    offset = 0
+    if not os.path.exists(f):
+        return records, offset
+    with open(f, 'rb') as fh:
+        while True:
+            header = fh.read(JOURNAL_FRAME.size)
+            if len(header) < JOURNAL_FRAME.size:
+                break
+            n, crc = JOURNAL_FRAME.unpack(header)
+            payload = fh.read(n)
+            if len(payload) < n or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            try:
+                records.append(cPickle.loads(payload))
+            except Exception:
+                break
+            offset += JOURNAL_FRAME.size + n
+    return records, offset
+
+
+def replay_journal(data_obj):
+    """
+    Rebuilds the state of a freshly unpickled data instance by applying the
+    records in its journal, in order. Records written before the instance was
+    last pickled are skipped. A damaged tail is truncated so that subsequent
+    records are appended after the last intact one.
+    """
+    if getattr(data_obj, '_journal_base', None) != data_obj.abs_filename:
+        return
+    f = journal_filename(data_obj)
+    records, offset = read_journal(f)
+    if os.path.exists(f) and os.path.getsize(f) > offset:
+        with open(f, 'r+b') as fh:
+            fh.truncate(offset)
+    base = data_obj._journal_control
+    for record in records:
+        if record['generation'] != data_obj._journal_generation:
+            continue
+        if 'all_data' in record:
+            data_obj.data = record['all_data']
+        elif data_obj.data is None:
+            data_obj.data = record['data']
+        else:
+            data_obj.data += record['data']
+        data_obj.log += record['log']
+        if 'control_len' in record:
+            n = record['control_len']
+            data_obj.control = base[len(base) - n:]
+        else:
+            data_obj.control = base = record['control']
+        data_obj.__dict__.update(record['state'])
+        data_obj._journal_nrecords += 1
+    data_obj._journal_control = data_obj.control
+    data_obj._journal_nrows = len(data_obj.data or [])
+    data_obj._journal_nlog = len(data_obj.log)
+    data_obj.to_log('%i journal records replayed' % data_obj._journal_nrecords)
 
 
 # TODO: This currently doesn't work!
@@ -193,8 +1115,11 @@ def delete_data(data_obj):
     """
     Deletes the data instance if found.
     """
+    flush()
     if os.path.exists(data_obj.abs_filename):
         os.remove(data_obj.abs_filename)
+    if os.path.exists(journal_filename(data_obj)):
+        os.remove(journal_filename(data_obj))
         
     data_obj.directory = pj(BACKUP_DATA_PATH, str((str(datetime.now()))).split('.')[0])
     data_obj.abs_filename = pj(data_obj.directory, data_obj.filename)
@@ -203,13 +1128,121 @@ def delete_data(data_obj):
     
 
 
+def _csv_cell(v):
+    """
+    Encodes a single value for writing to a csv file.
+    """
+    if isinstance(v, unicode):
+        v = v.encode('utf-8')
+    elif isinstance(v, float) and v != v:
+        v = ''  # as pandas writes NaN
+    return v
+
+
+def _cast(v, dtype):
+    """
+    Returns v cast to dtype, or NaN if v is None and dtype is float. Raises
+    ValueError instead of losing anything; int(1.7) would silently give 1.
+    """
+    if v is None and dtype is float:
+        return np.nan
+    if dtype is int and isinstance(v, (float, np.floating)) and \
+            not float(v).is_integer():
+        raise ValueError('%r is not an integer' % v)
+    return dtype(v)
+
+
+class TrialStore:
+
+    """
+    Typed, columnar copy of the trials in a Data instance. There is one numpy
+    array per entry in output_format; numeric columns get a numeric dtype and
+    everything else is an object array. Arrays grow by doubling, so adding a
+    trial costs amortised constant time, and each value is cast once when it
+    is added rather than every time the data are converted.
+    """
+
+    def __init__(self, output_format, source=None):
+        """
+        Initialise the store. source is the list of tuples the store mirrors.
+        """
+        self.output_format = list(output_format)
+        self.names = [name for name, _ in self.output_format]
+        self.source = source
+        self.n = 0
+        self.capacity = STORE_CAPACITY
+        self.columns = [np.empty(self.capacity, STORE_DTYPES.get(dtype, object))
+                        for _, dtype in self.output_format]
+
+    def grow(self):
+        """
+        Doubles the capacity of every column.
+        """
+        self.capacity *= 2
+        for j, col in enumerate(self.columns):
+            new_col = np.empty(self.capacity, col.dtype)
+            new_col[:self.n] = col[:self.n]
+            self.columns[j] = new_col
+
+    def append(self, row):
+        """
+        Casts the values in row to the types in output_format and adds them to
+        the end of the columns. A column is converted to an object array if
+        one of its values cannot be cast without losing anything (see
+        _cast), and the value is then kept as it is. Missing values (None, or columns
+        absent from rows recorded under an older output_format) are NaN in
+        float columns.
+        """
+        if self.n == self.capacity:
+            self.grow()
+        row = tuple(row) + (None,) * (len(self.output_format) - len(row))
+        for j, ((_, dtype), v) in enumerate(zip(self.output_format, row)):
+            col = self.columns[j]
+            try:
+                v = _cast(v, dtype)
+            except (ValueError, TypeError, UnicodeError):
+                if col.dtype != object:
+                    col = self.columns[j] = col.astype(object)
+            col[self.n] = v
+        self.n += 1
+
+    def extend(self, rows):
+        """
+        Appends each row in rows.
+        """
+        for row in rows:
+            self.append(row)
+
+    def column(self, name):
+        """
+        Returns a view of the filled part of the named column.
+        """
+        return self.columns[self.names.index(name)][:self.n]
+
+    def view(self):
+        """
+        Returns a dict of views of the filled part of every column.
+        """
+        return dict((name, col[:self.n]) for name, col in
+                    zip(self.names, self.columns))
+
+    def rows(self, start=0, stop=None):
+        """
+        Returns the trials between start and stop as a list of tuples of cast
+        values.
+        """
+        if stop is None:
+            stop = self.n
+        return zip(*[col[start:stop] for col in self.columns])
+
+
 class Data:
 
     """
     This class contains attributes and methods necessary for recording a
     proband's progress in a given test. There must be one such instance per
-    proband and per test, pickled within the RAW_DATA_PATH. If proband_id is
-    'TEST', the instance is never pickled.
+    proband and per test, saved within the RAW_DATA_PATH (see pack_snapshot).
+    If proband_id is 'TEST', the instance is never saved.
     """
 
     def __init__(self, proband_id, lang, user_id, proj_id, test_name,
@@ -238,30 +1271,61 @@ class Data:
         self.log = []
         self.to_log('instance created')
 
+    def __getstate__(self):
+        """
+        The trial store can always be rebuilt from self.data, so it is left
+        out when the instance is pickled.
+        """
+        state = self.__dict__.copy()
+        state.pop('_store', None)
+        return state
+
     def update(self):
         """
         Saves the Data instance in its current state. Assumes the test was
-        actually started before this method was called.
+        actually started before this method was called. Trials are appended to
+        the journal; a full snapshot is only pickled the first time and once
+        the test is done.
         """
         self.last_updated = (str(datetime.now()))
         if not self.test_started:
             self.test_started = True
             self.date_started = datetime.now()
-        save_data(self)
+        if self.test_done:
+            save_data(self)
+        else:
+            append_journal(self)
         self.to_log('instance updated')
         if self.test_done:
             self.date_done = datetime.now()
 
+    def trial_store(self):
+        """
+        Returns the TrialStore mirroring self.data, first adding any trials
+        appended since it was last used. The store is rebuilt if self.data
+        has been replaced or output_format has changed. None and an empty list
+        count as the same (empty) data, so the store is kept until the first
+        trial.
+        """
+        rows = self.data or []
+        store = getattr(self, '_store', None)
+        replaced = store is not None and store.source is not self.data and \
+            bool(store.source or self.data)
+        if store is None or replaced or \
+                store.output_format != list(self.output_format) or \
+                store.n > len(rows):
+            store = self._store = TrialStore(self.output_format, self.data)
+        store.extend(rows[store.n:])
+        return store
+
     def to_df(self):
         """
-        Converts the raw data (currently stored in a list of tuples) to a
-        pandas DataFrame.
+        Converts the raw data to a pandas DataFrame. The columns come straight
+        from the typed arrays in the trial store, so nothing is converted to
+        strings and back.
         """
-        names, dtypes = zip(*self.output_format)
-        print self.data
-        df = pandas.DataFrame(np.array(self.data).T, names).transpose()
-        for name, dtype in self.output_format:
-            df[name] = df[name].astype(dtype)
+        store = self.trial_store()
+        df = pandas.DataFrame(store.view(), columns=store.names)
         self.to_log('pandas DataFrame of data created')
         return df
 
@@ -269,9 +1333,13 @@ class Data:
         """
         Exports the data to csv format. Requires an entry for this task in
         the DATA_FORMATS csv. If no argument is given, the data are put in
-        the default folder.
+        the default folder. When writing to the same file as last time with
+        the same output_format, only the trials added since then are appended;
+        otherwise the whole file is rewritten. Either way the rows are written
+        with the csv module, in the same format as pandas would write them,
+        so that pandas need not be imported during a test. The file is
+        written by the persistence thread (see write_behind).
         """
-        df = self.to_df()
         if not f:
             f = self.filename.split('.')[0] + '.csv'
             f = pj(CSV_DATA_PATH, f)
@@ -279,9 +1347,29 @@ class Data:
             os.makedirs(CSV_DATA_PATH)
         if self.proband_id != 'TEST':
             self.update()
-            df.to_csv(f, index=False)
+            store = self.trial_store()
+            if getattr(self, '_csv_path', None) == f and \
+                    self._csv_format == self.output_format and \
+                    self._csv_nrows <= store.n and os.path.exists(f):
+                self.append_csv(f, store.rows(self._csv_nrows))
+            else:
+                write_behind(_write_csv, f, [[_csv_cell(v) for v in row] for
+                                             row in store.rows()], store.names)
+            self._csv_path = f
+            self._csv_format = list(self.output_format)
+            self._csv_nrows = store.n
         self.to_log('data saved as csv to %s' % f)
 
+    def append_csv(self, f, rows):
+        """
+        Appends rows (a list of tuples of values already cast by the trial
+        store) to the csv file f, on the persistence thread.
+        """
+        if not rows:
+            return
+        write_behind(_write_csv, f, [[_csv_cell(v) for v in row] for row in
+                                     rows])
+
     def to_log(self, s):
         """
         Adds the string s to the log.
@@ -300,37 +1388,38 @@ class Data:
         """
         Sends data to the local sqlite database. If a 'summary_method'
         function is supplied, the summary statistics for the test are
-        calculated and added to the local db.
+        calculated and added to the local db. Only this proband's rows are
+        written, in a single transaction: their trials replace any already in
+        the trials table, and their summary is upserted into the summary
+        table, which is keyed on proband_id and test_name.
         """
         if self.proband_id == 'TEST':
             print '---Not adding TEST to local db.'
             return
         self.update()
-        df1 = self.to_df()
+        if summary_method is not None:
+            names, sum_columns, sum_rows = df_rows(
+                summary_method(self, instructions))
+            key = [k for k in SUMMARY_KEY if k in names]
+        store = self.trial_store()
+        columns = [(name, SQL_TYPES.get(dtype, 'TEXT')) for name, dtype in
+                   self.output_format]
         table_name = self.test_name + '_trials'
-        con = sqlite3.connect(LOCAL_DB_F)
-        try:
-            df1.to_sql(table_name, con, index=False, if_exists='fail')
-        except:
-            s = 'SELECT * from %s' % table_name
-            df2 = pandas.read_sql(s, con, index_col=None)
-            df3 = pandas.concat([df1, df2])
-            df3 = df3.drop_duplicates()
-            df3.to_sql(table_name, con, index=False, if_exists='replace')
+        con = connect()
+        with con:
+            # tables first: sqlite3 commits before any schema change
+            create_trials_table(con, table_name, columns)
+            if summary_method is not None:
+                create_table(con, self.test_name, sum_columns, key)
+            replace_proband_rows(con, table_name, store.names, store.rows(),
+                                 self.proband_id)
+            if summary_method is not None:
+                upsert_rows(con, self.test_name, names, sum_rows)
+                record_proband_test(con, self.proband_id, self.user_id,
+                                    self.proj_id, self.test_name)
         self.to_log('trial-by-trial data added to local db')
         if summary_method is not None:
-            df1 = summary_method(self, instructions)
-            table_name = self.test_name
-            try:
-                df1.to_sql(table_name, con, index=False, if_exists='fail')
-            except:
-                s = 'SELECT * from %s' % table_name
-                df2 = pandas.read_sql(s, con, index_col=None)
-                df3 = pandas.concat([df1, df2])
-                df3 = df3.drop_duplicates()
-                df3.to_sql(table_name, con, index=False, if_exists='replace')
             self.to_log('summary stats added to local db')
-        con.close()
 
 
 if __name__ == '__main__':
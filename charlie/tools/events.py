@@ -6,14 +6,246 @@ Created on Tue Jun 03 14:19:17 2014
 @author: Sam Mathias
 """
 
+from collections import deque
+import ctypes
+import ctypes.util
+import sys
+import time
 import pygame
 
 
 DEFAULT_ITI_NOFEEDBACK = 0.1
 DEFAULT_ITI_FEEDBACK = 1.
+SPIN_MARGIN = 0.002  # seconds before a deadline to stop sleeping and spin
+POLL_INTERVAL = 0.001  # seconds to sleep between checks of the event queue
 
 Clock = pygame.time.Clock
-clear = pygame.event.clear
+_pending = deque()  # (event, timestamp) pairs taken off the pygame queue
+_times = {'flip': None, 'onset': None, 'response': None}
+_input = {'script': None, 'expect': {}}  # scripted input for headless runs
+
+
+def _monotonic_clock():
+    """
+    Returns a function giving the time in seconds from a high-resolution
+    clock that never goes backwards: QueryPerformanceCounter on Windows,
+    clock_gettime(CLOCK_MONOTONIC) elsewhere. Falls back to time.time.
+    """
+    if sys.platform == 'win32':
+        kernel32 = ctypes.windll.kernel32
+        freq = ctypes.c_int64()
+        kernel32.QueryPerformanceFrequency(ctypes.byref(freq))
+        freq = float(freq.value)
+
+        def clock():
+            counter = ctypes.c_int64()
+            kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+            return counter.value / freq
+
+        return clock
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    monotonic = 6 if sys.platform == 'darwin' else 1
+    try:
+        lib = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+        gettime = ctypes.CDLL(lib).clock_gettime
+        if gettime(monotonic, ctypes.byref(timespec())) != 0:
+            return time.time
+    except (OSError, AttributeError, TypeError):
+        return time.time
+
+    def clock():
+        ts = timespec()
+        gettime(monotonic, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return clock
+
+
+now = _monotonic_clock()
+
+
+class VirtualClock:
+
+    """
+    Stands in for the real clock in headless runs. Time only passes when
+    something waits, and waiting takes no real time, so a test runs as fast
+    as it can draw while its data show the durations it asked for.
+    """
+
+    def __init__(self, start=0.):
+        self.t = start
+
+    def now(self):
+        """
+        Returns the virtual time in seconds.
+        """
+        return self.t
+
+    def sleep_until(self, t):
+        """
+        Moves the virtual time on to t, if it is in the future.
+        """
+        self.t = max(self.t, t)
+
+
+def use_virtual_clock(clock=None):
+    """
+    Replaces now() and sleep_until() with those of a VirtualClock. Only
+    makes sense together with a response script (see set_script), since
+    nobody can press a key in virtual time.
+    """
+    global now, sleep_until
+    if clock is None:
+        clock = VirtualClock()
+    now = clock.now
+    sleep_until = clock.sleep_until
+    return clock
+
+
+def set_script(script):
+    """
+    Replaces real input with a response script (see charlie.tools.headless).
+    Whenever a test waits for input, script.respond(types, expect) is called
+    with the event types being waited for and a dict describing the valid
+    responses. It returns a (delay, event) pair, or None for no response.
+    """
+    _input['script'] = script
+
+
+def expect(**kwargs):
+    """
+    Describes the input about to be waited for, for the response script.
+    """
+    _input['expect'] = kwargs
+
+
+def _scripted_event(types, deadline):
+    """
+    Asks the response script for the next event, waiting for it on the clock.
+    """
+    response = _input['script'].respond(types, _input['expect'])
+    if response is None:
+        if deadline is None:
+            raise RuntimeError('no scripted response to a wait without a '
+                               'deadline')
+        sleep_until(deadline)
+        return None
+    delay, event = response
+    if deadline is not None and now() + delay > deadline:
+        sleep_until(deadline)
+        return None
+    sleep_until(now() + delay)
+    return event, now()
+
+
+def mark_flip():
+    """
+    Records the current time as that of the latest display update, which is
+    taken as the onset of the stimulus responded to next. Returns the time.
+    """
+    _times['flip'] = now()
+    return _times['flip']
+
+
+def onset_time():
+    """
+    Returns the time of the latest display update, or the current time if the
+    display has not been updated.
+    """
+    if _times['flip'] is None:
+        return now()
+    return _times['flip']
+
+
+def record_response(timestamp, onset=None):
+    """
+    Records a response made at timestamp to a stimulus shown at onset (by
+    default, the latest display update). Returns the RT in ms.
+    """
+    if onset is None:
+        onset = onset_time()
+    _times['onset'], _times['response'] = onset, timestamp
+    return (timestamp - onset) * 1000.
+
+
+def response_times():
+    """
+    Returns the onset and response timestamps of the latest response, in
+    seconds on the now() clock, for appending to trial data. Both are None if
+    no response has been recorded since the last call.
+    """
+    times = [_times['onset'], _times['response']]
+    _times['onset'] = _times['response'] = None
+    return times
+
+
+def clear_events():
+    """
+    Clears the event queue, including events already timestamped.
+    """
+    pygame.event.clear()
+    _pending.clear()
+
+
+clear = clear_events
+
+
+def sleep_until(t):
+    """
+    Idles until now() reaches t. The thread sleeps until SPIN_MARGIN seconds
+    before t, then spins for the remainder, so the deadline is met to within
+    a few microseconds without keeping a core busy.
+    """
+    remaining = t - now() - SPIN_MARGIN
+    if remaining > 0:
+        time.sleep(remaining)
+    while now() < t:
+        pass
+
+
+def present_at(t, update=None):
+    """
+    Waits until time t, then updates the display (with pygame.display.flip
+    unless another update function is given). Returns the time at which the
+    update returned.
+    """
+    sleep_until(t)
+    if update is None:
+        update = pygame.display.flip
+    update()
+    return now()
+
+
+def next_event(types, deadline=None):
+    """
+    Idles until an event of one of the given types arrives or until the
+    deadline (a time from now()) passes, and returns the event and its
+    timestamp, or None on a timeout. The queue is checked every POLL_INTERVAL
+    seconds, so events are timestamped within that long of their arrival.
+    Events of other types are discarded.
+    """
+    while 1:
+        while _pending:
+            event, timestamp = _pending.popleft()
+            if event.type in types:
+                return event, timestamp
+        if _input['script'] is not None:
+            return _scripted_event(types, deadline)
+        timestamp = now()
+        _pending.extend((e, timestamp) for e in pygame.event.get())
+        if _pending:
+            continue
+        if deadline is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        remaining = deadline - now()
+        if remaining <= 0:
+            return None
+        if remaining > SPIN_MARGIN:
+            time.sleep(min(POLL_INTERVAL, remaining - SPIN_MARGIN))
 
 
 def wait(t):
@@ -21,27 +253,25 @@ def wait(t):
     Just waits (literally does nothing) for t seconds.
     """
     pygame.event.pump()
-    pygame.time.wait(int(t*1000))
+    sleep_until(now() + t)
 
 
 def wait_for_keydown(escape=True, clear=False):
     """
     Idles until a key is pressed. Optionally kills python if it detects
-    Esc. Returns the event and the length of time since the function was
-    called.
+    Esc. Returns the event and the RT in ms, measured from the latest display
+    update to the moment the keydown was taken off the queue.
     """
     if clear:
-        pygame.event.clear()
+        clear_events()
     pygame.event.set_allowed(None)
     pygame.event.set_allowed(pygame.KEYDOWN)
-    clock = Clock()
-    clock.tick_busy_loop()
-    while 1:
-        event = pygame.event.wait()
-        if escape and event.key == pygame.K_ESCAPE:
-            return 'EXIT'
-        else:
-            return event, clock.tick_busy_loop()
+    onset = onset_time()
+    event, timestamp = next_event([pygame.KEYDOWN])
+    if escape and event.key == pygame.K_ESCAPE:
+        return 'EXIT'
+    else:
+        return event, record_response(timestamp, onset)
 
 
 def poll_for_valid_keydown(valid_responses, check_type, escape=True):
@@ -52,7 +282,7 @@ def poll_for_valid_keydown(valid_responses, check_type, escape=True):
     times: those should be recorded in the loop that calls this function.
     """
     try:
-        event = pygame.event.poll()
+        event = _pending.popleft()[0] if _pending else pygame.event.poll()
     except:
         return None
     if event.type == pygame.KEYDOWN:
@@ -72,6 +302,7 @@ def wait_for_valid_keydown(valid_responses, check_type, escape=True):
     responses and whether those are unicodes or pygame keys. Optionally kills
     python if it detects Esc.
     """
+    expect(keys=valid_responses, check_type=check_type)
     while 1:
         keydown = wait_for_keydown(escape)
         if keydown == 'EXIT':
@@ -84,6 +315,27 @@ def wait_for_valid_keydown(valid_responses, check_type, escape=True):
             return event.key, rt
 
 
+def wait_for_valid_keydown_until(valid_responses, check_type, deadline,
+                                 escape=True):
+    """
+    Like wait_for_valid_keydown, but gives up at the deadline (a time from
+    now()), returning None. Otherwise returns the response and the time the
+    key was pressed.
+    """
+    expect(keys=valid_responses, check_type=check_type)
+    while 1:
+        keydown = next_event([pygame.KEYDOWN], deadline)
+        if keydown is None:
+            return None
+        event, timestamp = keydown
+        if escape and event.key == pygame.K_ESCAPE:
+            return 'EXIT'
+        if check_type == 'unicode' and event.unicode in valid_responses:
+            return event.unicode, timestamp
+        if check_type == 'key' and event.key in valid_responses:
+            return event.key, timestamp
+
+
 def wait_for_arrowkey(labels=None):
     """
     A specific variety of valid_keydown check that returns the arrowkey
@@ -100,22 +352,22 @@ def wait_for_arrowkey(labels=None):
 def wait_for_mouse_click(escape=True, clear=False):
     """
     Idles until the mouse is clicked. Optionally kills python if it detects
-    Esc.
+    Esc. Returns the event and the RT in ms from the latest display update.
     """
     pygame.mouse.set_visible(True)
     if clear:
-        pygame.event.clear()
+        clear_events()
     pygame.event.set_allowed(None)
     pygame.event.set_allowed([pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN])
-    clock = Clock()
-    clock.tick_busy_loop()
+    onset = onset_time()
     while 1:
-        event = pygame.event.wait()
+        event, timestamp = next_event([pygame.KEYDOWN,
+                                       pygame.MOUSEBUTTONDOWN])
         if event.type == pygame.KEYDOWN:
             if escape and event.key == pygame.K_ESCAPE:
                 return 'EXIT'
         else:
-            return event, clock.tick_busy_loop()
+            return event, record_response(timestamp, onset)
 
 
 def wait_for_valid_mouse_click(screen, button, escape=True, clear=False):
@@ -124,6 +376,7 @@ def wait_for_valid_mouse_click(screen, button, escape=True, clear=False):
     of pygame Rects. Returns the zone index, the clicked rect itself, and the
     rt.
     """
+    expect(screen=screen, button=button)
     valid = False
     while not valid:
         mouse_click = wait_for_mouse_click(escape)
@@ -153,7 +406,7 @@ def poll_for_valid_mouse_click(screen, button, escape=True):
         pygame.event.set_allowed(None)
         pygame.event.set_allowed([pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN])
     try:
-        event = pygame.event.poll()
+        event = _pending.popleft()[0] if _pending else pygame.event.poll()
     except:
         return None
     if event.type == pygame.KEYDOWN:
@@ -168,5 +421,29 @@ def poll_for_valid_mouse_click(screen, button, escape=True):
             return None
 
 
+def wait_for_valid_mouse_click_until(screen, button, deadline, escape=True):
+    """
+    Idles until a mouse click is made within a valid zone or until the
+    deadline (a time from now()) passes, returning None. Otherwise returns
+    the zone index and the time of the click.
+    """
+    expect(screen=screen, button=button)
+    pygame.mouse.set_visible(True)
+    pygame.event.set_allowed(None)
+    pygame.event.set_allowed([pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN])
+    while 1:
+        click = next_event([pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN], deadline)
+        if click is None:
+            return None
+        event, timestamp = click
+        if event.type == pygame.KEYDOWN:
+            if escape and event.key == pygame.K_ESCAPE:
+                return 'EXIT'
+        elif event.button == button:
+            valid, i = screen.check_if_inside_clickable(event.pos)
+            if valid:
+                return i, timestamp
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
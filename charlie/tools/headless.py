@@ -0,0 +1,205 @@
+"""
+Headless runs of the pygame tests, for regression testing without a display
+or a proband. For example,
+
+    python -m charlie.tools.headless -b olin -p CI001 --seed 1
+
+runs every pygame test in the olin batch with the SDL dummy drivers. Time is
+virtual (see events.VirtualClock), so waits and stimulus durations take no
+real time, and input comes from a response script rather than a keyboard or
+mouse. Tests run from a GUI (the Qt tests) are skipped.
+
+A response script (-s) is a text file with one response per line:
+
+    <delay> <response>
+
+where delay is the RT in seconds and response is a key code or a clickable
+zone index (whichever the test is waiting for), a character for tests that
+check unicode input, or 'none' to let a timed trial run out. Lines starting
+with # are ignored. Once the script runs out, responses are random but
+valid, with RTs drawn uniformly from RT_RANGE.
+
+Data are written to a temporary directory (see data.set_data_path), never to
+the package's data, and it is deleted at the end unless --keep is given. To
+diff the output of two runs, give each its own directory with -o.
+"""
+
+from collections import deque
+import os
+import random
+import shutil
+import tempfile
+import time
+import pygame
+import charlie.tools.arguments as arguments
+import charlie.tools.batch as batch
+import charlie.tools.data as data
+import charlie.tools.lazy as lazy
+import charlie.tools.events as events
+
+
+RT_RANGE = 0.3, 1.2
+
+
+def read_script(f):
+    """
+    Reads a response script from the file at path f. Returns a list of
+    (delay, response) pairs.
+    """
+    entries = []
+    for line in open(f, 'rU'):
+        line = line.split('#')[0].split()
+        if not line:
+            continue
+        delay, response = float(line[0]), line[1]
+        if response.isdigit():
+            response = int(response)
+        elif response.lower() == 'none':
+            response = None
+        else:
+            response = response.decode('utf-8')
+        entries.append((delay, response))
+    return entries
+
+
+class ResponseScript:
+
+    """
+    Scripted input for headless runs. Each time a test waits for input, the
+    next entry is turned into a keydown or a mouse click, or into no response
+    at all. Random valid responses are made once the entries run out.
+    """
+
+    def __init__(self, entries=(), seed=None):
+        self.entries = deque(entries)
+        self.random = random.Random(seed)
+
+    def respond(self, types, expect):
+        """
+        Returns the delay and event of the next response to a wait for events
+        of the given types, or None for no response. expect describes the
+        valid responses (see events.expect).
+        """
+        if self.entries:
+            delay, response = self.entries.popleft()
+            if response is None:
+                return None
+        else:
+            delay, response = self.random.uniform(*RT_RANGE), None
+        if pygame.MOUSEBUTTONDOWN in types:
+            return delay, self.click(expect, response)
+        return delay, self.keydown(expect, response)
+
+    def keydown(self, expect, response):
+        """
+        Returns a keydown event for the response, or for a random valid key.
+        """
+        if response is None:
+            keys = expect.get('keys') or [pygame.K_SPACE]
+            response = self.random.choice(list(keys))
+        if isinstance(response, basestring):
+            key = ord(response) if len(response) == 1 else 0
+            return pygame.event.Event(pygame.KEYDOWN, key=key,
+                                      unicode=response, mod=0)
+        return pygame.event.Event(pygame.KEYDOWN, key=response,
+                                  unicode=u'', mod=0)
+
+    def click(self, expect, response):
+        """
+        Returns a click in the centre of the clickable zone whose index is the
+        response, or of a random zone.
+        """
+        screen = expect.get('screen')
+        if screen is None or not screen.zones:
+            pos = pygame.display.get_surface().get_rect().center
+        else:
+            if response is None:
+                response = self.random.randrange(len(screen.zones))
+            pos = pygame.Rect(screen.zones[response]).center
+        return pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos,
+                                  button=expect.get('button') or 1)
+
+
+def enable(script=None):
+    """
+    Switches to headless mode: dummy SDL video and audio drivers, a virtual
+    clock, and input from the given ResponseScript (random responses if
+    None). Must be called before the first Screen is created.
+    """
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    events.use_virtual_clock()
+    events.set_script(script or ResponseScript())
+
+
+def run_test(test_name):
+    """
+    Runs one test headlessly. Returns the batch.Test instance together with
+    the virtual and real seconds the run took, or None if the test is not a
+    pygame test. Such tests are skipped before they are imported, as they
+    need Qt.
+    """
+    if not batch.is_pygame_test(test_name):
+        print '---Skipping %s: it is not a pygame test.' % test_name
+        return None
+    test = batch.Test(test_name, True)
+    t0, v0 = time.time(), events.now()
+    test.run_pygame()
+    return test, events.now() - v0, time.time() - t0
+
+
+def run_tests(test_names):
+    """
+    Runs the given tests headlessly, one after another. Returns a list of
+    (test_name, number of trials, virtual seconds, real seconds) tuples, one
+    per test run.
+    """
+    report = []
+    for test_name in test_names:
+        result = run_test(test_name)
+        if result is not None:
+            test, virtual, real = result
+            report.append((test_name, len(test.data_obj.data or []), virtual,
+                           real))
+    return report
+
+
+def print_report(report):
+    """
+    Prints the output of run_tests as a table.
+    """
+    print '%-24s %8s %12s %10s' % ('test', 'trials', 'virtual (s)', 'real (s)')
+    for row in report:
+        print '%-24s %8i %12.1f %10.2f' % row
+    print '%-24s %8i %12.1f %10.2f' % (
+        'total', sum(r[1] for r in report), sum(r[2] for r in report),
+        sum(r[3] for r in report)
+    )
+
+
+def main():
+    args = arguments.get_args()
+    entries = read_script(args.script) if args.script else ()
+    enable(ResponseScript(entries, args.seed))
+    path = args.output_dir or tempfile.mkdtemp(prefix='charlie_headless_')
+    print '---Writing data to %s.' % path
+    data.set_data_path(path)
+    try:
+        data.bootstrap()
+        if args.batch_file:
+            test_names = batch.tests_in_batch(args.batch_file)
+        else:
+            test_names = [args.test_name]
+        print_report(run_tests(test_names))
+        if args.startup_report:
+            lazy.report()
+    finally:
+        data.flush()
+        if args.output_dir or args.keep:
+            print '---Kept the data in %s.' % path
+        else:
+            shutil.rmtree(path, True)
+
+
+if __name__ == '__main__':
+    main()
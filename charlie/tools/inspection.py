@@ -13,12 +13,12 @@ __author__ = 'smathias'
 
 import datetime
 import os
-import sqlite3
-import pandas
 import numpy
-import matplotlib.pyplot as plt
 import charlie.tools.data as data
+import charlie.tools.lazy as lazy
 import charlie.tools.plots as plots
+pandas = lazy.lazy_import('pandas')
+plt = lazy.lazy_import('matplotlib.pyplot')
 
 
 def load_localdb(table_names=None):
@@ -28,7 +28,7 @@ def load_localdb(table_names=None):
     :return: A dict where each key represents a table and each entry is a
     pandas.DataFrame object.
     """
-    con = sqlite3.connect(data.LOCAL_DB_F)
+    con = data.connect()
     if table_names is None:
         s = "SELECT * FROM sqlite_master WHERE type='table'"
         df = pandas.read_sql(s, con)
@@ -52,7 +52,7 @@ def load_summaries(tests=None):
         stuff = load_localdb()
         tables = set(stuff.keys())
         excl = [t for t in tables if '_trials' in t]
-        excl += ['probands', 'projects', 'users']
+        excl += ['probands', 'projects', 'users', 'proband_tests']
         excl = set(excl)
         wanted = tables.difference(excl)
         stuff = {k: stuff[k] for k in wanted}
@@ -85,6 +85,29 @@ def create_master_summary_df():
     return df
 
 
+def create_raw_data_df():
+    """
+    Create a pandas.DataFrame object with one row per .data file in the raw
+    data folder, from the headers alone (see data.read_header): who started
+    or completed which test, when, and how many trials they have done and
+    have left. The counts are as of the last snapshot, so a test that is
+    still in progress may have more trials in its journal. Damaged files are
+    left out.
+    """
+    rows = []
+    for f in sorted(data.ld(data.RAW_DATA_PATH)):
+        if not f.endswith('.data'):
+            continue
+        try:
+            header = data.read_header(data.pj(data.RAW_DATA_PATH, f))
+        except ValueError as e:
+            print '---%s' % e
+            continue
+        header['filename'] = f
+        rows.append(header)
+    return pandas.DataFrame(rows)
+
+
 def inspect_times():
     """
     Inspects the times taken to complete each task. Creates a summary figure
@@ -0,0 +1,114 @@
+"""
+Deferred imports, and a report of how long start-up takes.
+
+Most of the big libraries are not needed until a test is over (pandas and
+scipy, for the summary stats) or are only needed by some tests and tools (Qt,
+web.py for the questionnaires, paramiko for backups, matplotlib for plots).
+Importing all of them before the first instruction splash made pygame tests
+slow to start. A module that is not needed straight away is imported with
+lazy_import:
+
+    pandas = lazy.lazy_import('pandas')
+
+This returns a stand-in, and the real module is imported the first time one
+of its attributes is used. Each deferred import is timed, and so is the time
+from START to milestones such as the first splash (see mark). START is when
+this module was first imported, which batch does before anything else. Run a
+test or a batch with --startup_report to print the timings and see whether
+start-up stayed within STARTUP_BUDGET.
+"""
+
+from collections import OrderedDict
+import importlib
+import sys
+import time
+import types
+
+
+START = time.time()
+STARTUP_BUDGET = 2.  # seconds from START to the first splash
+FIRST_SPLASH = 'first splash'
+_imports = []  # (module name, seconds to import, seconds since START)
+_milestones = OrderedDict()  # name : seconds since START
+
+
+def load(*names):
+    """
+    Imports and returns the first module in names that can be imported (e.g.,
+    'PySide.QtGui', 'PyQt4.QtGui'), recording how long it took unless it had
+    already been imported.
+    """
+    for name in names:
+        if sys.modules.get(name) is not None:
+            return sys.modules[name]
+        t0 = time.time()
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            if name == names[-1]:
+                raise
+            continue
+        _imports.append((name, time.time() - t0, t0 - START))
+        return module
+
+
+class LazyModule(types.ModuleType):
+
+    """
+    Stands in for a module until one of its attributes is first used, at
+    which point the module is imported with load.
+    """
+
+    def __init__(self, *names):
+        types.ModuleType.__init__(self, names[0])
+        self.__dict__['_names'] = names
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = load(*self._names)
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+
+def lazy_import(*names):
+    """
+    Returns a LazyModule for the first module in names that can be imported.
+    """
+    return LazyModule(*names)
+
+
+def mark(milestone):
+    """
+    Records the time since START at which the milestone was first reached.
+    """
+    if milestone not in _milestones:
+        _milestones[milestone] = time.time() - START
+
+
+def report():
+    """
+    Prints the milestones and the deferred imports, slowest first, and
+    whether the first splash came within STARTUP_BUDGET.
+    """
+    print '---Start-up report (seconds since start):'
+    for milestone, t in _milestones.iteritems():
+        print '%-32s %8.3f' % (milestone, t)
+    print '---Deferred imports (seconds to import, when):'
+    for name, t, when in sorted(_imports, key=lambda i: -i[1]):
+        print '%-32s %8.3f %8.3f' % (name, t, when)
+    t = _milestones.get(FIRST_SPLASH)
+    if t is None:
+        print '---No splash was shown.'
+    elif t > STARTUP_BUDGET:
+        print '---OVER BUDGET: first splash at %.3f s (budget %.3f s).' % (
+            t, STARTUP_BUDGET)
+    else:
+        print '---First splash at %.3f s, within the %.3f s budget.' % (
+            t, STARTUP_BUDGET)
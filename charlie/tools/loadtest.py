@@ -0,0 +1,208 @@
+"""
+Load tests of the local database and the summaries pipeline. For example,
+
+    python -m charlie.tools.loadtest -b olin -n 10000 --seed 1
+
+creates 10,000 synthetic probands who have each completed every pygame test
+in the olin batch and passes their data through the same calls as a real
+session. Each Data instance is saved, exported to csv, summarised, and sent
+to the local database with its summary stats. As the database grows, three
+things are timed at regular checkpoints: data.populate_demographics,
+inspection.create_master_summary_df, and the query behind the manager's
+proband table. At the end, the throughput and latency percentiles of each
+stage are printed.
+
+Synthetic data are built from templates. First, each test is run headlessly
+(see charlie.tools.headless) TEMPLATES times with random responses, which
+exercises its control_method and trial_method. Each synthetic proband then
+gets the trials of a randomly chosen template, with their RTs jittered. Qt
+tests cannot be run headlessly, so they are skipped. Everything is written to
+a fresh temporary directory (see data.set_data_path), never to the package's
+data, which is deleted at the end unless --keep is given.
+"""
+
+from array import array
+import random
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import charlie.tools.arguments as arguments
+import charlie.tools.batch as batch
+import charlie.tools.data as data
+import charlie.tools.events as events
+import charlie.tools.headless as headless
+import charlie.tools.inspection as inspection
+
+
+TEMPLATES = 3
+CHECKPOINTS = 10
+RT_COLUMNS = ('rt', 'rt_first', 'total_time')
+RT_JITTER = 0.2
+PERCENTILES = 50, 90, 99
+PROBAND_STAGES = ['save', 'csv', 'summary', 'localdb']
+DB_STAGES = ['demographics', 'master_summary', 'proband_table']
+
+
+def make_templates(test_names, n, seed=None):
+    """
+    Runs each test headlessly n times as the TEST proband, so nothing is
+    saved. Returns a dict of lists of finished batch.Test instances, keyed by
+    test name.
+    """
+    templates = {}
+    for i in range(n):
+        s = None if seed is None else seed + i
+        events.set_script(headless.ResponseScript(seed=s))
+        for test_name in test_names:
+            result = headless.run_test(test_name)
+            if result is not None:
+                templates.setdefault(test_name, []).append(result[0])
+    return templates
+
+
+def synthesize(test, proband_id, rng):
+    """
+    Returns a finished Data instance for proband_id containing a copy of the
+    trials from the template test, with RTs jittered.
+    """
+    names = [name for name, _ in test.output_format]
+    rt_cols = [j for j, name in enumerate(names) if name in RT_COLUMNS]
+    rows = []
+    for row in test.data_obj.data:
+        row = list(row)
+        row[names.index('proband_id')] = proband_id
+        for j in rt_cols:
+            if j < len(row) and isinstance(row[j], float) and row[j] == row[j]:
+                row[j] *= rng.lognormvariate(0, RT_JITTER)
+        rows.append(tuple(row))
+    data_obj = data.Data(proband_id, test.lang, test.user_id, test.proj_id,
+                         test.test_name, test.output_format)
+    data_obj.control = []
+    data_obj.data = rows
+    data_obj.test_done = True
+    return data_obj
+
+
+def timed(times, stage, f, *args):
+    """
+    Calls f(*args), adds the time it took to times[stage] and returns its
+    result.
+    """
+    t0 = time.time()
+    result = f(*args)
+    times[stage].append(time.time() - t0)
+    return result
+
+
+def run_proband(templates, proband_id, rng, times):
+    """
+    Creates one synthetic proband and passes their data for every test
+    through the persistence and summary stages.
+    """
+    for test_name in sorted(templates):
+        test = rng.choice(templates[test_name])
+        summary_method = getattr(test.mod, 'summary_method')
+        data_obj = synthesize(test, proband_id, rng)
+        timed(times, 'save', data_obj.update)
+        timed(times, 'csv', data_obj.to_csv)
+        timed(times, 'summary', summary_method, data_obj, test.instr)
+        timed(times, 'localdb', data_obj.to_localdb, summary_method,
+              test.instr)
+
+
+def proband_table():
+    """
+    Runs the query behind the manager's proband table.
+    """
+    return data.connect().execute('SELECT * FROM probands').fetchall()
+
+
+def checkpoint():
+    """
+    Times the stages that read the whole database. Returns a dict of seconds,
+    keyed by stage.
+    """
+    times = dict((stage, []) for stage in DB_STAGES)
+    timed(times, 'demographics', data.populate_demographics)
+    timed(times, 'master_summary', inspection.create_master_summary_df)
+    timed(times, 'proband_table', proband_table)
+    return dict((stage, t[0]) for stage, t in times.iteritems())
+
+
+def run(templates, n, seed=None):
+    """
+    Runs the load test with n synthetic probands. Returns the per-call times
+    of each proband stage, the total seconds spent on probands, and a list of
+    (number of probands, checkpoint times) pairs.
+    """
+    rng = random.Random(seed)
+    times = dict((stage, array('d')) for stage in PROBAND_STAGES)
+    every = max(n // CHECKPOINTS, 1)
+    checkpoints = []
+    elapsed = 0
+    for i in xrange(n):
+        t0 = time.time()
+        run_proband(templates, 'LT%06i' % i, rng, times)
+        elapsed += time.time() - t0
+        if (i + 1) % every == 0 or i + 1 == n:
+            print '---%i probands done.' % (i + 1)
+            checkpoints.append((i + 1, checkpoint()))
+    return times, elapsed, checkpoints
+
+
+def print_report(times, elapsed, checkpoints):
+    """
+    Prints the output of run as two tables.
+    """
+    n = checkpoints[-1][0] if checkpoints else 0
+    pcols = ' '.join('%8s' % ('p%i' % p) for p in PERCENTILES)
+    print '%-16s %8s %10s %8s %s %8s' % ('stage', 'calls', 'calls/s',
+                                         'mean', pcols, 'max')
+    for stage in PROBAND_STAGES:
+        t = np.array(times[stage]) * 1000
+        if not len(t):
+            continue
+        pvals = ' '.join('%8.2f' % p for p in np.percentile(t, PERCENTILES))
+        print '%-16s %8i %10.1f %8.2f %s %8.2f' % (
+            stage, len(t), len(t) / t.sum() * 1000, t.mean(), pvals, t.max()
+        )
+    print '%i probands in %.1f s (%.2f probands/s); times in ms.' % (
+        n, elapsed, n / elapsed if elapsed else 0
+    )
+    print
+    print '%-10s %s' % ('probands', ' '.join('%16s' % s for s in DB_STAGES))
+    for i, t in checkpoints:
+        print '%-10i %s' % (i, ' '.join('%16.2f' % (t[s] * 1000) for s in
+                                        DB_STAGES))
+    print 'Whole-database stages; times in ms.'
+
+
+def main():
+    args = arguments.get_args()
+    if args.proband_id != 'TEST':
+        sys.exit('Load tests create their own probands; omit -p.')
+    path = tempfile.mkdtemp(prefix='charlie_loadtest_')
+    print '---Writing synthetic data to %s.' % path
+    data.set_data_path(path)
+    try:
+        headless.enable()
+        data.bootstrap()
+        if args.batch_file:
+            test_names = batch.tests_in_batch(args.batch_file)
+        else:
+            test_names = [args.test_name]
+        print '---Running each test headlessly to make templates.'
+        templates = make_templates(test_names, TEMPLATES, args.seed)
+        print_report(*run(templates, args.probands, args.seed))
+    finally:
+        data.flush()
+        if args.keep:
+            print '---Kept the synthetic data in %s.' % path
+        else:
+            shutil.rmtree(path, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -75,6 +75,9 @@ class SetupTab(QtGui.QWidget):
 
         self.db = QSqlDatabase.addDatabase("QSQLITE")
         self.db.setDatabaseName(data.LOCAL_DB_F)
+        self.db.setConnectOptions(
+            'QSQLITE_BUSY_TIMEOUT=%i' % (data.DB_TIMEOUT * 1000)
+        )
         self.db.open()
         self.model = QSqlQueryModel()
         self.model.setQuery("select * from probands", self.db)
@@ -6,7 +6,8 @@ __author__ = 'smathias'
 
 
 import numpy as np
-import matplotlib.pyplot as plt
+import charlie.tools.lazy as lazy
+plt = lazy.lazy_import('matplotlib.pyplot')
 
 def bar_chart(labels, values, xlabel=None, ylabel=None, title=None):
     """
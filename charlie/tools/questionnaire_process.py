@@ -3,8 +3,6 @@ __author__ = 'Sam Mathias'
 
 
 from datetime import datetime
-import sqlite3
-import pandas
 import charlie.tools.data as data
 import charlie.tools.summaries as summaries
 import charlie.tools.arguments as arguments
@@ -264,13 +262,8 @@ def process_form_data(form):
         if args.proband_id != 'TEST':
             f = '%s_%s.csv' % (args.proband_id, q_name)
             df.to_csv(data.pj(data.QUESTIONNAIRE_DATA_PATH, f))
-            con = sqlite3.connect(data.LOCAL_DB_F)
-            try:
-                df.to_sql(q_name, con, index=False, if_exists='fail')
-            except:
-                s = 'SELECT * from %s' % q_name
-                df2 = pandas.read_sql(s, con, index_col=None)
-                df3 = pandas.concat([df, df2])
-                df3 = df3.drop_duplicates()
-                df3.to_sql(q_name, con, index=False, if_exists='replace')
-            con.close()
+            con = data.connect()
+            with con:
+                data.upsert_df(con, q_name, df)
+                data.record_proband_test(con, args.proband_id, args.user_id,
+                                         args.proj_id, q_name)
@@ -0,0 +1,199 @@
+"""
+Recomputes the summary tables in the local database from the raw data, for
+example after a bug in a summary_method has been fixed:
+
+    python -m charlie.tools.rescore -t ipcpts
+
+Every saved Data instance of the test (or of every test in the batch given
+with -b, or of every test if neither is given) is loaded, and the test's
+summary_method is run on it in a pool of worker processes (-w; one per CPU by
+default). Only completed tests are rescored, as only they have summaries;
+the others are skipped after reading just the header of their file. The
+results for each test are written to the local database in one transaction,
+replacing the old rows. Progress is printed as the probands are scored,
+followed by a report of the throughput for each test.
+"""
+
+from collections import OrderedDict
+import glob
+import importlib
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import charlie.tools.arguments as arguments
+import charlie.tools.batch as batch
+import charlie.tools.data as data
+import charlie.tools.instructions as instructions
+
+
+PROGRESS_INTERVAL = 1.  # seconds between progress reports
+MAX_ERRORS_SHOWN = 5
+_worker = {'modules': {}, 'instructions': {}}
+
+
+def raw_files(test_name):
+    """
+    Returns the paths of the pickled Data instances for the given test.
+    """
+    return sorted(glob.glob(data.pj(data.RAW_DATA_PATH,
+                                    '*_%s.data' % test_name)))
+
+
+def completed(f, test_name):
+    """
+    Returns True if the header of the .data file at path f says the given test
+    was completed. Only the header is read (see data.read_header).
+    """
+    try:
+        header = data.read_header(f)
+    except ValueError:
+        return True  # let score report it
+    return header['test_name'] == test_name and header['test_done']
+
+
+def all_test_names():
+    """
+    Returns the names of all the tests in the battery.
+    """
+    return sorted(f[:-3] for f in data.ld(data.TESTS_PATH) if
+                  f.endswith('.py') and not f.startswith('_'))
+
+
+def _init_worker():
+    """
+    Silences the summary methods, which print a lot, in worker processes.
+    """
+    sys.stdout = open(os.devnull, 'w')
+
+
+def score(job):
+    """
+    Runs the summary method on one pickled Data instance. job is a (path,
+    test name) pair. Returns a tuple whose first item says what happened:
+    ('done', path, proband, names, columns, rows), where proband is a
+    (proband_id, user_id, proj_id) tuple and the rest comes from
+    data.df_rows; ('skipped', path) if the test was not completed or the
+    file belongs to another test; or ('failed', path, traceback).
+    """
+    f, test_name = job
+    try:
+        data_obj = data.read_snapshot(f)
+        if data_obj.test_name != test_name or not data_obj.test_done:
+            return 'skipped', f
+        mods = _worker['modules']
+        if test_name not in mods:
+            mods[test_name] = importlib.import_module('charlie.tests.' +
+                                                      test_name)
+        instr = _worker['instructions']
+        if (test_name, data_obj.lang) not in instr:
+            instr[test_name, data_obj.lang] = instructions.read_instructions(
+                test_name, data_obj.lang)
+        summary_method = getattr(mods[test_name], 'summary_method')
+        df = summary_method(data_obj, instr[test_name, data_obj.lang])
+        proband = data_obj.proband_id, data_obj.user_id, data_obj.proj_id
+        return ('done', f, proband) + data.df_rows(df)
+    except Exception:
+        return 'failed', f, traceback.format_exc()
+
+
+def write_summaries(test_name, results):
+    """
+    Upserts the rows from score into the test's summary table, and records
+    each proband as having completed the test, in one transaction. Columns
+    found in any proband's summary are added to the table.
+    """
+    columns = OrderedDict()
+    groups = OrderedDict()
+    for _, _, proband, names, cols, rows in results:
+        for name, sql_type in cols:
+            columns.setdefault(name, sql_type)
+        groups.setdefault(tuple(names), []).extend(rows)
+    key = [k for k in data.SUMMARY_KEY if k in columns]
+    con = data.connect()
+    with con:
+        data.create_table(con, test_name, columns.items(), key)
+        for names, rows in groups.iteritems():
+            data.upsert_rows(con, test_name, names, rows)
+        for _, _, proband, _, _, _ in results:
+            data.record_proband_test(con, *(proband + (test_name, )))
+
+
+def rescore_test(test_name, pool, workers):
+    """
+    Rescores every proband who completed the given test, using a pool with
+    the given number of workers. Returns a dict of counts and timings for the
+    report, and prints progress along the way.
+    """
+    files = raw_files(test_name)
+    jobs = [(f, test_name) for f in files if completed(f, test_name)]
+    report = {'test_name': test_name, 'files': len(files), 'done': 0,
+              'skipped': len(files) - len(jobs), 'failed': 0, 'errors': []}
+    if not jobs:
+        report.update(score_time=0., write_time=0.)
+        return report
+    results = []
+    t0 = last = time.time()
+    chunksize = max(1, len(jobs) // (workers * 4))
+    for i, result in enumerate(pool.imap_unordered(score, jobs, chunksize)):
+        report[result[0]] += 1
+        if result[0] == 'done':
+            results.append(result)
+        elif result[0] == 'failed':
+            report['errors'].append(result[1:])
+        if time.time() - last >= PROGRESS_INTERVAL or i + 1 == len(jobs):
+            last = time.time()
+            print '---%s: %i/%i files, %.1f files/s, %i failed.' % (
+                test_name, i + 1, len(jobs), (i + 1) / max(last - t0, 1e-6),
+                report['failed'])
+    t1 = time.time()
+    if results:
+        write_summaries(test_name, results)
+    report.update(score_time=t1 - t0, write_time=time.time() - t1)
+    return report
+
+
+def print_report(reports):
+    """
+    Prints the output of rescore_test for each test as a table, followed by
+    the first few errors.
+    """
+    print '%-24s %6s %6s %7s %6s %9s %9s %8s' % (
+        'test', 'files', 'done', 'skipped', 'failed', 'score (s)',
+        'write (s)', 'files/s')
+    for r in reports:
+        total = r['score_time'] + r['write_time']
+        print '%-24s %6i %6i %7i %6i %9.2f %9.2f %8.1f' % (
+            r['test_name'], r['files'], r['done'], r['skipped'], r['failed'],
+            r['score_time'], r['write_time'],
+            r['files'] / total if total else 0)
+    errors = [e for r in reports for e in r['errors']]
+    for f, tb in errors[:MAX_ERRORS_SHOWN]:
+        print '\n---Failed to rescore %s:\n%s' % (f, tb)
+    if len(errors) > MAX_ERRORS_SHOWN:
+        print '---%i more failures not shown.' % (len(errors) -
+                                                   MAX_ERRORS_SHOWN)
+
+
+def main():
+    args = arguments.get_args()
+    data.bootstrap()
+    if args.batch_file:
+        test_names = batch.tests_in_batch(args.batch_file)
+    elif args.test_name:
+        test_names = [args.test_name]
+    else:
+        test_names = all_test_names()
+    workers = args.workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, _init_worker)
+    try:
+        reports = [rescore_test(t, pool, workers) for t in test_names]
+    finally:
+        pool.close()
+        pool.join()
+    print_report(reports)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,9 @@ from platform import system
 from getpass import getuser
 from socket import gethostname
 import numpy as np
-from scipy.stats import norm
-import pandas
+import charlie.tools.lazy as lazy
+pandas = lazy.lazy_import('pandas')
+scipy_stats = lazy.lazy_import('scipy.stats')
 
 
 def get_universal_stats(data_obj):
@@ -96,6 +97,7 @@ def get_sdt_stats(df, noise, signal, prefix='', ans_col='ans', rsp_col='rsp',
     :param rsp_col: str
     :return: (cols, entries)
     """
+    norm = scipy_stats.norm
     N = len(df[df[ans_col] == noise])
     S = len(df[df[ans_col] == signal])
     H = len(df[(df[ans_col] == signal) & (df[rsp_col] == signal)])
@@ -171,6 +173,7 @@ def sdt_yesno(N, S, H, F):
     Calculates d', c, k and beta using maximum likelihood for th equal-variance
     Gaussian SDT model.
     """
+    norm = scipy_stats.norm
     if N < 10 or S < 10:
         print '---SDT warning: This does not look right:', (N, S, H, F)
     if F == 0 or F == N:
@@ -375,32 +378,129 @@ def get_gonogo(df, prefix='', choices=('Yes', 'No'), ans_col='ans'):
     return a + c + f, b + d + g
 
 
+RT_COLS = ['rt_mean', 'rt_mean_outrmvd', 'rt_outrmvd']
+SDT_COUNTS = ['N', 'S', 'H', 'F']
+
+
+def combination_stats(df, condition_set, choices=None, ans_col='ans',
+                      rsp_col='rsp', rt_col='rt'):
+    """
+    Computes summary stats for every combination of conditions at once.
+    condition_set is a list of (column name, values) pairs, where values may
+    include 'all' (a margin: the condition is ignored). Instead of filtering a
+    copy of df for each combination, every trial is given the index of its
+    cell once for each pattern of margins in use, and the stats of all cells
+    are tallied together with np.bincount: the number of trials, correct
+    trials and (if choices are given) N, S, H and F, and the mean RT and 3-SD
+    trimmed mean RT of correct trials, as in get_rt.
+
+    Returns a list of (conditions, stats) pairs in the order given by
+    cartesian, where stats is a dict with 'ntrials', 'ncorrect', the RT_COLS
+    and, if choices are given, the SDT_COUNTS. Values are matched to cells by
+    their string representation, since cartesian turns every value into a
+    string when the conditions mix types.
+    """
+    names = [c[0] for c in condition_set]
+    combinations = cartesian([c[1] for c in condition_set])
+    levels, codes = [], []
+    for name in names:
+        values, inverse = np.unique(df[name].astype(str).values,
+                                    return_inverse=True)
+        levels.append(dict((v, i) for i, v in enumerate(values)))
+        codes.append(inverse)
+    correct = (df[ans_col] == df[rsp_col]).values
+    counts = {'ntrials': np.ones(len(df)), 'ncorrect': correct}
+    if choices:
+        yes, no = choices
+        said_yes = (df[rsp_col] == yes).values
+        counts['N'] = (df[ans_col] == no).values
+        counts['S'] = (df[ans_col] == yes).values
+        counts['H'] = counts['S'] & said_yes
+        counts['F'] = counts['N'] & said_yes
+    rt = df[rt_col].values.astype(float)
+    valid = correct & ~np.isnan(rt)
+    x = rt[valid]
+
+    cells = {}
+    for pattern in set(tuple(v != 'all' for v in c) for c in combinations):
+        dims = [j for j, used in enumerate(pattern) if used]
+        shape = tuple(len(levels[j]) for j in dims)
+        size = int(np.prod(shape))
+        if dims:
+            cell = np.ravel_multi_index([codes[j] for j in dims], shape)
+        else:
+            cell = np.zeros(len(df), int)
+        stats = dict((k, np.bincount(cell, v, size)) for k, v in
+                     counts.iteritems())
+        c = cell[valid]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # bincount returns ints when it is given no trials
+            m = np.bincount(c, minlength=size).astype(float)
+            mean = np.bincount(c, x, size) / m
+            sd = np.sqrt(np.bincount(c, (x - mean[c]) ** 2, size) / (m - 1))
+            kept = np.abs(x - mean[c]) <= 3 * sd[c]
+            k = np.bincount(c[kept], minlength=size)
+            stats['rt_mean'] = mean
+            stats['rt_mean_outrmvd'] = np.bincount(c[kept], x[kept], size) / \
+                k.astype(float)
+        stats['rt_outrmvd'] = np.bincount(cell[correct], minlength=size) - k
+        cells[pattern] = dims, shape, stats
+
+    empty = dict((k, 0) for k in counts)
+    empty.update({'rt_mean': np.nan, 'rt_mean_outrmvd': np.nan,
+                  'rt_outrmvd': 0})
+    results = []
+    for conditions in combinations:
+        dims, shape, stats = cells[tuple(v != 'all' for v in conditions)]
+        try:
+            i = [levels[j][str(conditions[j])] for j in dims]
+        except KeyError:  # a value that never occurs
+            results.append((conditions, empty.copy()))
+            continue
+        i = np.ravel_multi_index(i, shape) if dims else 0
+        cell = dict((k, v[i]) for k, v in stats.iteritems())
+        for k in counts:
+            cell[k] = int(cell[k])
+        cell['rt_outrmvd'] = int(cell['rt_outrmvd'])
+        results.append((conditions, cell))
+    return results
+
+
+def _prefixed(prefix, cols):
+    """
+    Returns the column names with the prefix added.
+    """
+    return ['%s_%s' % (prefix, col) for col in cols]
+
+
+def _accuracy_entries(stats):
+    """
+    Returns the entries of get_accuracy followed by those of get_rt for one
+    cell of combination_stats.
+    """
+    n, ncorrect = stats['ntrials'], stats['ncorrect']
+    pcorrect = None if n == 0 else ncorrect / float(n)
+    rt = [stats['rt_mean'], stats['rt_mean_outrmvd'], stats['rt_outrmvd']]
+    return [n, ncorrect, pcorrect] + rt + rt
+
+
 def get_all_combinations_2alt(df, condition_set, choices=('Yes', 'No'),
                               ans_col='ans'):
     """
     Generates all possible combinations of the conditions and generates
     summary stats for all of them. Suitable for any test that uses the basic
-    yes-no paradigm.
+    yes-no paradigm. The stats are the same as get_2alt's, but are computed
+    for every combination at once (see combination_stats).
     """
     print '--Getting all combinations.'
-    all_conditions = cartesian([c[1] for c in condition_set])
-    condition_names = [c[0] for c in condition_set]
     cols, entries = [], []
-
-    for conditions in all_conditions:
-        print '--Getting all values.'
-        df2 = df.copy(True)
-        for name, val in zip(condition_names, conditions):
-            if val != 'all':
-                try:
-                    df2 = df2[df2[name] == val]
-                except TypeError:
-                    df2 = df2[df2[name] == int(val)]
-
+    acc_cols = ['ntrials', 'ncorrect', 'pcorrect'] + RT_COLS + RT_COLS
+    for conditions, stats in combination_stats(df, condition_set, choices,
+                                               ans_col):
         prefix = '_'.join(str(c).lower() for c in conditions)
-        a, b = get_2alt(df2, prefix, choices, ans_col)
-        cols += a
-        entries += b
+        cols += _prefixed(prefix, acc_cols + ['d', 'c'])
+        entries += _accuracy_entries(stats)
+        entries += list(sdt_yesno(*[stats[k] for k in SDT_COUNTS]))
 
     return cols, entries
 
@@ -409,24 +509,17 @@ def get_all_combinations_malt(df, condition_set, choices=('Yes', 'No'),
                               ans_col='ans'):
     """
     Generates all possible combinations of the conditions and generates
-    summary stats for all of them.
+    summary stats for all of them. The stats are the same as get_accuracy's
+    followed by get_rt's, but are computed for every combination at once (see
+    combination_stats).
     """
-    all_conditions = cartesian([c[1] for c in condition_set])
-    condition_names = [c[0] for c in condition_set]
     cols, entries = [], []
-
-    for conditions in all_conditions:
-
-        df2 = df.copy(True)
-        for name, val in zip(condition_names, conditions):
-            if val != 'all':
-                df2 = df2[df2[name] == val]
-
+    acc_cols = ['ntrials', 'ncorrect', 'pcorrect'] + RT_COLS + RT_COLS
+    for conditions, stats in combination_stats(df, condition_set,
+                                               ans_col=ans_col):
         prefix = '_'.join(str(c).lower() for c in conditions)
-        a, b = get_accuracy(df2, prefix, ans_col)
-        c, d = get_rt(df2[df2[ans_col] == df2.rsp], prefix)
-        cols = cols + a + c
-        entries = entries + b + d
+        cols += _prefixed(prefix, acc_cols)
+        entries += _accuracy_entries(stats)
 
     return cols, entries
 
@@ -0,0 +1,88 @@
+"""
+Converts the .data files saved by older versions of charlie to the current
+snapshot format (see data.pack_snapshot):
+
+    python -m charlie.tools.upgrade
+
+Every .data file in the raw data folder and in the backups is checked. Files
+in an older format (plain pickles, or version 1 snapshots) are read, written
+out again in the current format and read back. A file is only replaced once
+the new version has been read back and found to hold exactly the same data;
+otherwise it is left alone and reported. Journals need no conversion.
+"""
+
+import math
+import os
+import charlie.tools.data as data
+
+
+def data_files():
+    """
+    Returns the paths of every .data file in the raw data folder and the
+    backups.
+    """
+    files = []
+    for path in (data.RAW_DATA_PATH, data.BACKUP_DATA_PATH):
+        for root, _, names in os.walk(path):
+            files += [data.pj(root, f) for f in names if f.endswith('.data')]
+    return sorted(files)
+
+
+def same(a, b):
+    """
+    Returns True if a and b are equal and of the same types all the way down,
+    counting NaNs as equal.
+    """
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, float) and math.isnan(a):
+        return math.isnan(b)
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return set(a) == set(b) and all(same(a[k], b[k]) for k in a)
+    return a == b
+
+
+def upgrade_file(f):
+    """
+    Converts the file at path f to the current format. Returns 'upgraded',
+    'current' if it was already in the current format, or 'failed'.
+    """
+    if data.snapshot_version(f) == data.SNAPSHOT_VERSION:
+        return 'current'
+    data_obj = data.read_snapshot(f)
+    payload = data.pack_snapshot(data_obj)
+    tmp = f + '.upgrade'
+    with open(tmp, 'wb') as fh:
+        fh.write(payload)
+    try:
+        if not same(data_obj.__getstate__(),
+                    data.read_snapshot(tmp).__getstate__()):
+            return 'failed'
+        data.replace_file(f, payload, True)
+    finally:
+        os.remove(tmp)
+    return 'upgraded'
+
+
+def main():
+    data.bootstrap()
+    data.flush()
+    counts = {'upgraded': 0, 'current': 0, 'failed': 0}
+    files = data_files()
+    for f in files:
+        try:
+            result = upgrade_file(f)
+        except ValueError as e:
+            print '---Could not read %s: %s' % (f, e)
+            result = 'failed'
+        if result == 'failed':
+            print '---Left %s as it was.' % f
+        counts[result] += 1
+    print '---%i files: %i upgraded, %i already current, %i failed.' % (
+        len(files), counts['upgraded'], counts['current'], counts['failed'])
+
+
+if __name__ == '__main__':
+    main()
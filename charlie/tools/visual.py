@@ -6,10 +6,17 @@ Created on Thu Jan 15 10:51:08 2015
 @author: smathias
 """
 
+from collections import OrderedDict
+import os
+import threading
 import numpy as np
 import pygame
+import charlie.tools.atlas as atlas
+import charlie.tools.audio as audio
 import charlie.tools.events as events
 import charlie.tools.data as data
+import charlie.tools.lazy as lazy
+import charlie.tools.misc as misc
 
 
 BLACK = 0, 0, 0
@@ -25,10 +32,261 @@ BLUE = 0, 0, 255
 BG_COLOUR = LIGHT_GREY
 DEFAULT_TEXT_COLOUR = BLACK
 WINDOW = 800, 800
+IMAGE_CACHE_MB = 256
+PRELOAD_AHEAD = 5
+TEXT_CACHE_SIZE = 512
+FRAME_RATE = 60.  # nominal refresh rate of the display, in Hz
 
 Rect = pygame.Rect
 
 
+class SurfaceCache:
+
+    """
+    Least-recently-used cache of decoded images, already converted to the
+    pixel format of the display. Surfaces are keyed on the absolute path of
+    the file and the display format, so each image is decoded at most once
+    while it stays in the cache. The oldest surfaces are dropped once the
+    total size of the cache exceeds max_mb megabytes.
+    """
+
+    def __init__(self, max_mb=IMAGE_CACHE_MB):
+        self.surfaces = OrderedDict()
+        self.nbytes = 0
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+
+    def key(self, f):
+        """
+        Returns the cache key for the image at path f.
+        """
+        display = pygame.display.get_surface()
+        if display:
+            fmt = display.get_bitsize(), display.get_masks()
+        else:
+            fmt = None
+        return os.path.abspath(f), fmt
+
+    def get(self, f):
+        """
+        Returns the surface for the image at path f, loading and converting it
+        if it is not already in the cache. The pixels come from the test's
+        atlas where possible. Safe to call from a preloader thread; the file
+        is decoded outside the lock.
+        """
+        k = self.key(f)
+        with self.lock:
+            surface = self.surfaces.pop(k, None)
+            if surface is not None:
+                self.surfaces[k] = surface
+                return surface
+        surface = atlas.load(f).convert_alpha()
+        with self.lock:
+            if k in self.surfaces:
+                return self.surfaces[k]
+            self.surfaces[k] = surface
+            self.nbytes += surface.get_pitch() * surface.get_height()
+            self.evict()
+        return surface
+
+    def evict(self):
+        """
+        Drops the least-recently-used surfaces until the cache is under its
+        size limit. The most recent surface is always kept. Call with the lock
+        held.
+        """
+        while self.nbytes > self.max_bytes and len(self.surfaces) > 1:
+            _, surface = self.surfaces.popitem(last=False)
+            self.nbytes -= surface.get_pitch() * surface.get_height()
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        with self.lock:
+            self.surfaces.clear()
+            self.nbytes = 0
+
+
+surface_cache = SurfaceCache()
+
+
+class TextCache:
+
+    """
+    Least-recently-used cache of rendered text. Rendering a string with a
+    TrueType font is slow compared with blitting the result, and the same
+    strings (instructions, response words, feedback colours) are drawn over
+    and over, so surfaces are keyed on the font, string, colour and
+    antialiasing flag and kept until more than max_size strings have been
+    rendered since they were last used. Surfaces are shared, so callers must
+    not draw onto them.
+    """
+
+    def __init__(self, max_size=TEXT_CACHE_SIZE):
+        self.surfaces = OrderedDict()
+        self.max_size = max_size
+
+    def render(self, font, s, colour, antialias=True):
+        """
+        Returns font.render(s, antialias, colour), rendering the string only
+        if it is not already in the cache.
+        """
+        k = font, s, tuple(colour), antialias
+        surface = self.surfaces.pop(k, None)
+        if surface is None:
+            surface = font.render(s, antialias, colour)
+            if len(self.surfaces) >= self.max_size:
+                self.surfaces.popitem(last=False)
+        self.surfaces[k] = surface
+        return surface
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        self.surfaces.clear()
+
+
+text_cache = TextCache()
+
+
+class Images:
+
+    """
+    Dict-like container of the images a Screen knows about. Each key maps to
+    the path of an image file, and looking a key up returns its surface from
+    the shared surface cache. A key that was never added is treated as a path
+    itself.
+    """
+
+    def __init__(self, cache=surface_cache):
+        self.cache = cache
+        self.paths = OrderedDict()
+
+    def register(self, key, f=None):
+        """
+        Adds an image under key without loading it. f is the path of the file,
+        if this is not key itself.
+        """
+        self.paths[key] = f or key
+
+    def add(self, key, f=None):
+        """
+        Adds an image under key and loads it into the cache. Returns the
+        surface.
+        """
+        self.register(key, f)
+        return self[key]
+
+    def __getitem__(self, key):
+        return self.cache.get(self.paths.get(key, key))
+
+    def __contains__(self, key):
+        return key in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def keys(self):
+        return self.paths.keys()
+
+
+def stimulus_manifest(test_name, control):
+    """
+    Lists the images in the test's folder of visual stimuli in the order they
+    will be needed. Returns (manifest, extra): manifest has one list of paths
+    per item in the control iterable, namely the images named in that item;
+    extra contains the remaining images, which trial methods use without
+    naming them in the control iterable (e.g., the ipcpts symbols).
+    """
+    p = data.pj(data.VISUAL_PATH, test_name)
+    if not os.path.exists(p):
+        return [], []
+    files = [data.pj(p, f) for f in data.ld(p)]
+    files = [f for f in files if misc.is_imgfile(f)]
+    known = set(files)
+    manifest = []
+    seen = set()
+    for trial in control or []:
+        paths = [v for v in trial if isinstance(v, basestring) and v in known
+                 and v not in seen]
+        seen.update(paths)
+        manifest.append(paths)
+    extra = [f for f in files if f not in seen]
+    return manifest, extra
+
+
+class Preloader(threading.Thread):
+
+    """
+    Background thread that decodes a test's images into the surface cache in
+    trial order, staying at most 'ahead' trials in front of the trial
+    currently running. Images not tied to a particular trial are decoded
+    straight after the first few trials. Call advance() each time a trial
+    starts and stop() when the test is over.
+    """
+
+    def __init__(self, manifest, extra, ahead=PRELOAD_AHEAD, cache=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cache = cache or surface_cache
+        self.ahead = ahead
+        self.queue = []
+        for i, paths in enumerate(manifest):
+            if i == ahead:
+                self.queue += [(0, f) for f in extra]
+            self.queue += [(i, f) for f in paths]
+        if len(manifest) <= ahead:
+            self.queue += [(0, f) for f in extra]
+        self.current = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def advance(self):
+        """
+        Marks the start of the next trial, allowing the thread to decode
+        another trial's worth of images.
+        """
+        with self.condition:
+            self.current += 1
+            self.condition.notify()
+
+    def stop(self):
+        """
+        Stops the thread after the image it is currently decoding.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        for due, f in self.queue:
+            with self.condition:
+                while not self.stopped and due >= self.current + self.ahead:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            try:
+                self.cache.get(f)
+            except pygame.error:
+                continue
+
+
+def preload(test_name, control, ahead=PRELOAD_AHEAD):
+    """
+    Starts and returns a Preloader for the images in the test's stimulus
+    folder, in the order given by the control iterable.
+    """
+    manifest, extra = stimulus_manifest(test_name, control)
+    preloader = Preloader(manifest, extra, ahead)
+    preloader.start()
+    return preloader
+
+
 class Screen:
 
     """
@@ -46,12 +304,15 @@ class Screen:
         (default option), the screen will be set to native resolution.
         """
         
+        audio.pre_init()
         pygame.init()
+        audio.init()
         pygame.mouse.set_visible(mouse)
         self.set_mouse = pygame.mouse.set_visible
 
         # containers for various things
-        self.images = {}  # filename : surface
+        self.images = Images()  # filename : surface
+        self.text = text_cache  # rendered strings
         self.zones = []  # ordered list of clickable rects
 
         # create display surface
@@ -60,6 +321,8 @@ class Screen:
         elif full:
             info = pygame.display.Info()
             self.window = (info.current_w, info.current_h)
+            if min(self.window) <= 0:  # no real display, e.g., headless
+                self.window = WINDOW
         else:
             self.window = WINDOW
         if full:
@@ -74,16 +337,116 @@ class Screen:
         self.x0, self.y0 = self.screen.get_rect().center
         self.centre = self.screen.get_rect().center
         self.reset_zones()
-        self.update = pygame.display.update
-        self.flip = pygame.display.flip
         self.kill = pygame.display.quit
 
+        # presentation schedule
+        self.frame_period = 1. / FRAME_RATE
+        self.frame_target = None  # when the next scheduled frame is due
+        self.frame_log = []  # (label, target, flip time) per scheduled frame
+
+    def reset(self):
+        """
+        Gets the screen ready for the next test in a session, so that the
+        display, fonts and mixer can be kept for the whole batch. The previous
+        test's images, zones, frame schedule and pending events are dropped,
+        and the display is cleared to the current BG_COLOUR.
+        """
+        pygame.mouse.set_visible(False)
+        pygame.event.clear()
+        self.images = Images()
+        self.reset_zones()
+        self.frame_target = None
+        self.frame_log = []
+        self.screen.fill(BG_COLOUR)
+        self.update()
+
+    def update(self, rects=None):
+        """
+        Updates the given rects of the display, or all of it, and records the
+        time of the update as the onset of whatever was just drawn.
+        """
+        if rects is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(rects)
+        return events.mark_flip()
+
+    def flip(self):
+        """
+        Flips the display and records the time of the flip as the onset of
+        whatever was just drawn.
+        """
+        pygame.display.flip()
+        return events.mark_flip()
+
+    def present(self, duration=None, label=None, rects=None):
+        """
+        Shows everything drawn since the previous frame at the time it is due,
+        and keeps it up for duration seconds, rounded to a whole number of
+        frames. The first call starts a schedule; each later frame is due a
+        whole number of frame periods after the start, so one late frame does
+        not push back the rest. A frame with no duration ends the schedule and
+        stays up until the next update. Returns the flip time.
+        """
+        target = self.frame_target
+        if target is None:
+            target = events.now()
+        t = events.present_at(target, lambda: self.update(rects))
+        self.record_frame(label, target, t)
+        if duration is None:
+            self.frame_target = None
+        else:
+            n = max(1, int(round(duration / self.frame_period)))
+            self.frame_target = target + n * self.frame_period
+        return t
+
+    def end_frames(self, wait=True):
+        """
+        Waits until the last scheduled frame has been up for its duration
+        (unless wait is False) and ends the schedule. The runners call this
+        with wait=False after every trial, so a trial that exits in the middle
+        of a schedule does not leave the next trial's first frame due at a
+        stale time.
+        """
+        if wait and self.frame_target is not None:
+            events.sleep_until(self.frame_target)
+        self.frame_target = None
+
+    def record_frame(self, label, target, t):
+        """
+        Adds a frame that was due at target and flipped at t to the frame log.
+        """
+        self.frame_log.append((label, target, t))
+
+    def frame_report(self):
+        """
+        Summarises the frames logged since the last call, or returns None if
+        there were none. A frame is late if it flipped more than half a frame
+        after it was due; each whole frame period of lateness is a dropped
+        frame.
+        """
+        if not self.frame_log:
+            return None
+        worst = max(t - target for _, target, t in self.frame_log)
+        late = [(label, t - target) for label, target, t in self.frame_log
+                if t - target > self.frame_period / 2.]
+        dropped = sum(int(x / self.frame_period) for _, x in late)
+        s = '%i frames, %i late, %i dropped, worst %.1f ms late' % (
+            len(self.frame_log), len(late), dropped, worst * 1000
+        )
+        if late:
+            s += ' (%s)' % ', '.join(str(label) for label, _ in late)
+        self.frame_log = []
+        return s
+
     def create_font(self, size=36, bold=False, italic=False):
         """
         Creates two font objects: self.font is for explanatory text, font2 is
-        for test-specific text.
+        for test-specific text. Text rendered with the old fonts is dropped
+        from the cache.
         """
         pygame.font.init()
+        self.text.clear()
         f = data.pj(data.FONTS_PATH, 'ClearSans-Regular.ttf')
         self.font = pygame.font.Font(f, size, bold=bold, italic=italic)
         f = data.pj(data.FONTS_PATH, 'ClearSans-Medium.ttf')
@@ -105,11 +468,11 @@ class Screen:
                     a.center = self.x0 + a.center[0], self.y0 + a.center[1]
                 self.screen.fill(BG_COLOUR, a)
             if update:
-                pygame.display.update(r)
+                self.update(r)
         else:
             self.screen.fill(BG_COLOUR)
             if update:
-                pygame.display.flip()
+                self.flip()
             self.images_visible = False
 
     def blit_text(self, s, pos, colour=None, blit=True, update=False,
@@ -121,7 +484,7 @@ class Screen:
             colour = DEFAULT_TEXT_COLOUR
         if not font:
             font = self.font
-        q = font.render(s, True, colour)
+        q = self.text.render(font, s, colour)
         r = q.get_rect()
         if prc:
             r.center = self.x0 + pos[0], self.y0 + pos[1]
@@ -131,7 +494,7 @@ class Screen:
             self.screen.fill(BG_COLOUR, r)
             self.screen.blit(q, r)
         if update:
-            pygame.display.update(r)
+            self.update(r)
         return q, r
 
     def splash(self, s, wait=True, mouse=False, clear_events=True, font=None):
@@ -158,7 +521,8 @@ class Screen:
         Y = [int(b - float(sum(Y)/float(len(Y)))) for b in Y]
         [self.blit_text(a, xy, update=False,
                         font=font) for a, xy in zip(S, zip(X, Y))]
-        pygame.display.update()
+        self.update()
+        lazy.mark(lazy.FIRST_SPLASH)
         if wait:
             if clear_events:
                 keydown = events.wait_for_keydown(clear=True)
@@ -177,23 +541,21 @@ class Screen:
         self.wipe()
         if not font:
             font = self.font2
-        clock = events.Clock()
-        current = 0
-        while current < t:
-            snew = s % int(round(t - current))
+        start = events.now()
+        for i in xrange(int(round(t))):
+            snew = s % (int(round(t)) - i)
             self.splash(snew, mouse=False, wait=False, font=font)
-            events.wait(0.98)
-            current += (clock.tick_busy_loop()/1000.)
+            events.sleep_until(start + i + 1)
     
     def blit_image(self, image, pos, blit=True, update=False, prc=True):
         """
         Blits a single image to the screen. 'image' can be a string
         representing the path of an image, a pygame surface, or a 2D numpy
-        array.
+        array. Paths are looked up in the surface cache, so a preloaded image
+        is never decoded again here.
         """
         if isinstance(image, basestring):
-            image = pygame.image.load(image)
-            image = image.convert_alpha()
+            image = self.images[image]
         elif type(image) == np.ndarray:
             image = image/2. + 0.5
             image = np.round(image * 255)
@@ -208,22 +570,34 @@ class Screen:
             self.screen.fill(BG_COLOUR, r)
             self.screen.blit(image, r)
         if update:
-            pygame.display.update(r)
+            self.update(r)
         return image, r
 
     def load_image(self, f):
         """
-        Preloads an image at path f and adds it to the preloaded_images
-        dictionary, where f is the key and the surface is the value. f can be
-        a list of paths.
+        Preloads an image at path f into the surface cache and adds it to the
+        images container, where f is the key. f can be a list of paths.
         """
         if not hasattr(f, '__iter__'):
             f = [f]
         for a in f:
-            image = pygame.image.load(a)
-            image = image.convert_alpha()
-            self.images[a] = image
-            print a, '->', image
+            self.images.add(a)
+
+    def preload_stimuli(self, test_name, control, ahead=PRELOAD_AHEAD,
+                        preloader=None):
+        """
+        Registers every image in the test's stimulus folder without decoding
+        any of them, and starts a Preloader that decodes them in the order
+        given by the control iterable (see preload). Returns the Preloader.
+        If a preloader for the test was already started, e.g., while the
+        previous test in a session was finishing, its images are registered
+        instead.
+        """
+        if preloader is None:
+            preloader = preload(test_name, control, ahead)
+        for _, f in preloader.queue:
+            self.images.register(f)
+        return preloader
 
     def load_keyboard_keys(self):
         """
@@ -233,9 +607,7 @@ class Screen:
         """
         p = data.pj(data.VISUAL_PATH, 'keyboard_keys')
         for a in [f for f in data.ld(p) if 'png' in f]:
-            image = pygame.image.load(data.pj(p, a))
-            image = image.convert_alpha()
-            self.images[a] = image
+            self.images.add(a, data.pj(p, a))
 
     def create_word_zones(self, words, spacing, y, font=None):
         """
@@ -309,7 +681,7 @@ class Screen:
         if border_colour and border_width:
             pygame.draw.rect(self.screen, border_colour, rect, border_width)
         if update:
-            pygame.display.update(rect)
+            self.update(rect)
     
     def blit_line(self, start, end, width, colour=None, prc=True):
         """
@@ -339,7 +711,7 @@ class Screen:
                 self.screen.blit(q, r)
                 R.append(r)
             if update:
-                pygame.display.update(R)
+                self.update(R)
             self.images_visible = True
 
     def change_word_colour(self, word, colour, update=False, font=None):
@@ -358,13 +730,13 @@ class Screen:
         R = []
         for w, c in zip(word, colour):
             q, r = self.wordzones[w]
-            q = font.render(w, True, c)
+            q = self.text.render(font, w, c)
             self.wordzones[w] = (q, r)
             self.screen.fill(BG_COLOUR, r)
             self.screen.blit(q, r)
             R.append(r)
         if update:
-            pygame.display.update(R)
+            self.update(R)
 
     def change_key_colour(self, key, colour, update=False, font=None):
         """
@@ -384,7 +756,7 @@ class Screen:
             self.screen.blit(q, r)
             R.append(r)
         if update:
-            pygame.display.update(R)
+            self.update(R)
 
     def check_if_inside_clickable(self, pos):
         """